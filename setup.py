@@ -85,9 +85,15 @@ setup(
             'sphinx-autodoc-typehints',
             'sphinx-rtd-theme',
         ],
+        'brotli': [
+            'brotli',  # brotli encoded /openapi responses
+        ],
         'dev': [
             'aiohttp-devtools'
         ],
+        'orjson': [
+            'orjson',  # faster jsonb decoding in the postgres plugin
+        ],
         'test': [
             'mockito',
             'pytest',
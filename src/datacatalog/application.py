@@ -1,13 +1,15 @@
+import asyncio
 import importlib
 import urllib.parse
 import logging
 
+import aiohttp
 from aiohttp import web
 import aiohttp_cors
 import aiopluggy
 
-from datacatalog import startup_actions
-from . import authorization, config, handlers, jwks, openapi, plugin_interfaces
+from datacatalog import rendering, startup_actions
+from . import authorization, config, handlers, jwks, openapi, plugin_interfaces, singleflight
 
 logger = logging.getLogger(__name__)
 
@@ -45,11 +47,18 @@ class Application(web.Application):
             path += '/'
         self['path'] = path
         self['openapi'] = openapi.openapi
-        self['jwks'] = jwks.load(self._config['jwks'])
+        # A mutable key set, so that the keys can be replaced after the app
+        # is frozen. Replacing them flushes the token cache, because the
+        # verifiers are another object:
+        self['jwks'] = jwks.MutableKeySet(jwks.load(self._config['jwks']))
+        self['token_cache'] = authorization.TokenCache()
+        self['dataset_flights'] = singleflight.Group()
+        self['body_cache'] = rendering.BodyCache()
 
         # set routes
         self.router.add_get(path + 'datasets', handlers.datasets.get_collection)
         self.router.add_post(path + 'datasets', handlers.datasets.post_collection)
+        self.router.add_post(path + 'datasets/_bulk', handlers.datasets.post_bulk)
 
         self.router.add_get(path + 'datasets/{dataset}', handlers.datasets.get)
         self.router.add_put(path + 'datasets/{dataset}', handlers.datasets.put)
@@ -72,6 +81,9 @@ class Application(web.Application):
         self._load_plugins()
         self._initialize_sync()
 
+        # After initialize_sync, in case plugins add paths to the definition:
+        self['path_matcher'] = authorization.PathMatcher(self['openapi']['paths'])
+
         # CORS
         # this must be done after initialize_sync: plugins may register new
         # routes during setup and our allow_cors applies to all routes.
@@ -123,9 +135,40 @@ async def _on_startup(app):
         if r.exception is not None:
             raise r.exception
     await startup_actions.run_startup_actions(app)
+    app['render_version'] = await rendering.version(app)
+    app['rerender_task'] = asyncio.ensure_future(_rerender_stale(app))
+    app['jwks_refresh_task'] = None
+    if 'jwks_source' in app.config:
+        source_config = app.config['jwks_source']
+        source = jwks.KeySource(
+            app['jwks'], path=source_config.get('path'), url=source_config.get('url')
+        )
+        try:
+            async with aiohttp.ClientSession() as session:
+                await source.refresh(session)
+        except jwks.JWKError:
+            logger.exception("Loading the JWKS failed; using the configured keys")
+        app['jwks_refresh_task'] = asyncio.ensure_future(
+            source.run(source_config.get('refresh_interval', 300))
+        )
+
+
+async def _rerender_stale(app):
+    try:
+        await rendering.rerender_stale(app)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Rendering of stale datasets failed")
 
 
 async def _on_cleanup(app):
+    tasks = [app['rerender_task']]
+    if app['jwks_refresh_task'] is not None:
+        tasks.append(app['jwks_refresh_task'])
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
     await app.hooks.deinitialize(app=app)
 
 
@@ -1,5 +1,7 @@
+import collections
 import logging
 import re
+import time
 import typing as T
 import urllib.parse
 
@@ -10,6 +12,60 @@ _logger = logging.getLogger(__name__)
 
 LOCAL_ALWAYS_OK = False
 
+_DEFAULT_TOKEN_CACHE_SIZE = 1024
+
+
+class TokenCache(object):
+    # language=rst
+    """Bounded LRU cache of verified access tokens.
+
+    Maps tokens to their ``(scopes, subject, exp)``, so that requests with a
+    token that was seen before skip the signature verification. Entries are
+    evicted when the token expires, and all entries are flushed when the set
+    of verification keys changes.
+
+    """
+
+    def __init__(self, maxsize: int=_DEFAULT_TOKEN_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._tokens: T.MutableMapping[str, T.Tuple[T.FrozenSet[str], str, T.Optional[float]]] = \
+            collections.OrderedDict()
+        self._verifiers = None
+
+    def _check_verifiers(self, verifiers: T.Mapping):
+        if verifiers is not self._verifiers:
+            self._tokens.clear()
+            self._verifiers = verifiers
+
+    def get(self, verifiers: T.Mapping, token: str) \
+            -> T.Optional[T.Tuple[T.FrozenSet[str], str, T.Optional[float]]]:
+        # language=rst
+        """The cached ``(scopes, subject, exp)`` of ``token``, if it hasn't expired.
+
+        :param verifiers: the current verification keys.
+
+        """
+        self._check_verifiers(verifiers)
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        exp = entry[2]
+        if exp is not None and exp <= time.time():
+            del self._tokens[token]
+            return None
+        self._tokens.move_to_end(token)
+        return entry
+
+    def put(self, verifiers: T.Mapping, token: str, scopes: T.Iterable[str],
+            subject: str, exp: T.Optional[float]):
+        # language=rst
+        """Remember a token that was verified with ``verifiers``."""
+        self._check_verifiers(verifiers)
+        self._tokens[token] = (frozenset(scopes), subject, exp)
+        self._tokens.move_to_end(token)
+        while len(self._tokens) > self.maxsize:
+            self._tokens.popitem(last=False)
+
 
 async def _extract_scopes(request: web.Request) -> T.Set:
     if not (LOCAL_ALWAYS_OK and request.url.host == 'localhost'):
@@ -21,6 +77,14 @@ async def _extract_scopes(request: web.Request) -> T.Set:
             return set()
 
         token = match[1]
+        keys = request.app['jwks'].verifiers
+        token_cache: TokenCache = request.app['token_cache']
+        cached = token_cache.get(keys, token)
+        if cached is not None:
+            request.authz_scopes = set(cached[0])
+            request.authz_subject = cached[1]
+            return request.authz_scopes
+
         try:
             header = jwt.get_unverified_header(token)
         except (jwt.InvalidTokenError, jwt.DecodeError):
@@ -29,8 +93,6 @@ async def _extract_scopes(request: web.Request) -> T.Set:
         if 'kid' not in header:
             raise web.HTTPBadRequest(text='Did not get a valid key identifier') from None
 
-        keys = request.app['jwks'].verifiers
-
         if header['kid'] not in keys:
             raise web.HTTPBadRequest(text="Unknown key identifier: {}".format(header['kid'])) from None
         key = keys[header['kid']]
@@ -46,6 +108,7 @@ async def _extract_scopes(request: web.Request) -> T.Set:
                 )
             scopes = set(access_token['scopes'])
             subject = access_token.get('sub', '')
+            token_cache.put(keys, token, scopes, subject, access_token.get('exp'))
         except jwt.ExpiredSignatureError:
             return set()
         except jwt.InvalidTokenError:
@@ -86,19 +149,58 @@ async def _extract_authz_info(request: web.Request,
     return result
 
 
+class PathMatcher(object):
+    # language=rst
+    """Finds the OpenAPI specification of request paths.
+
+    The path templates of the OpenAPI definition are compiled into regular
+    expressions once, when the application is created.
+
+    """
+
+    def __init__(self, paths: dict):
+        self.paths = paths
+        # If several templates match a path, the last one in the definition
+        # wins, so they are tried in reverse order:
+        self.templates = [
+            (re.compile(re.sub('{[^/]*}', '([^/]*)', path_name)), path_name)
+            for path_name in reversed(list(paths.keys()))
+        ]
+
+    def match(self, path: str, method: str=None) -> T.Tuple[T.Optional[str], T.Optional[dict]]:
+        """Adapted from swagger-parser library."""
+        # Get the specification of the given path
+        path_spec = None
+        path_name = None
+        if path in self.paths:
+            path_spec = self.paths[path]
+            path_name = path
+        else:
+            for regex_from_path, base_path in self.templates:
+                if regex_from_path.fullmatch(path):
+                    path_spec = self.paths[base_path]
+                    path_name = base_path
+                    break
+
+        # Test method if given
+        if path_spec is not None and method is not None and method in path_spec.keys():
+            path_spec = path_spec[method]
+
+        return path_name, path_spec
+
+
 async def middleware(app, handler):
-    openapi = app['openapi']
     baseurl = app.config['web']['baseurl']
     base_path = urllib.parse.urlparse(baseurl).path
     path_offset = len(base_path)
     if path_offset > 0 and base_path[-1] == '/':
         path_offset -= 1
-    paths = openapi['paths']
+    path_matcher = app['path_matcher']
 
     async def middleware_handler(request: web.Request) -> web.Response:
         req_path = request.rel_url.raw_path[path_offset:]
         method = request.method
-        path, pathspec = _get_path_spec(paths, req_path, method.lower())
+        path, pathspec = path_matcher.match(req_path, method.lower())
 
         if path is not None and 'security' in pathspec:
             await _enforce_one_of(request, pathspec['security'])
@@ -111,19 +213,23 @@ async def _enforce_one_of(request: web.Request,
                           security_requirements: T.List[T.Dict[
                               str, T.Optional[T.Iterable]]
                           ]):
+    security_definitions = request.app['openapi']['components']['securitySchemes']
+    # The credentials are extracted (and tokens decoded) only once, for all
+    # security requirements:
+    all_authz_info = None
     for security_requirement in security_requirements:
-        if await _enforce_all_of(request, security_requirement):
+        if all_authz_info is None:
+            all_authz_info = await _extract_authz_info(request, security_definitions)
+        if _enforce_all_of(security_definitions, all_authz_info, security_requirement):
             return
     raise web.HTTPUnauthorized()
 
 
-async def _enforce_all_of(request: web.Request,
-                          security_requirements: T.Dict[
-                              str, T.Optional[T.Iterable]
-                          ]) -> bool:
-    openapi = request.app['openapi']
-    security_definitions = openapi['components']['securitySchemes']
-    all_authz_info = await _extract_authz_info(request, security_definitions)
+def _enforce_all_of(security_definitions: T.Dict[str, T.Dict[str, T.Any]],
+                    all_authz_info: T.Dict[str, T.Any],
+                    security_requirements: T.Dict[
+                        str, T.Optional[T.Iterable]
+                    ]) -> bool:
     for requirement, scopes in security_requirements.items():
         authz_info = all_authz_info[requirement]
         security_type = security_definitions[requirement]['type']
@@ -138,24 +244,3 @@ async def _enforce_all_of(request: web.Request,
             raise web.HTTPInternalServerError()
     return True
 
-
-def _get_path_spec(paths: dict, path: str, method: str=None) -> T.Optional[T.Tuple[str, str]]:
-    """Adapted from swagger-parser library."""
-    # Get the specification of the given path
-    path_spec = None
-    path_name = None
-    if path in paths:
-        path_spec = paths[path]
-        path_name = path
-    else:
-        for base_path in paths.keys():
-            regex_from_path = re.compile(re.sub('{[^/]*}', '([^/]*)', base_path))
-            if re.fullmatch(regex_from_path, path):
-                path_spec = paths[base_path]
-                path_name = base_path
-
-    # Test method if given
-    if path_spec is not None and method is not None and method in path_spec.keys():
-        path_spec = path_spec[method]
-
-    return path_name, path_spec
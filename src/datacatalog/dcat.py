@@ -1,3 +1,5 @@
+import itertools
+import linecache
 import typing as T
 import logging
 
@@ -7,6 +9,109 @@ import jsonschema
 
 logger = logging.getLogger(__name__)
 
+Projection = T.Mapping[str, T.Optional['Projection']]
+# language=rst
+"""A selection of properties of an :class:`Object`.
+
+Maps the names of the selected properties to a projection of their values, or
+to ``None`` to select the whole value. The projection of a :class:`List`
+applies to its items.
+
+"""
+
+_MAX_CANONICALIZERS = 64
+# language=rst
+"""Number of projections for which an object keeps a compiled canonicalizer."""
+
+_schema_generation = itertools.count()
+# language=rst
+"""Incremented whenever an :class:`Object` gets a new property, which makes
+all compiled canonicalizers stale."""
+_current_generation = next(_schema_generation)
+_compilations = itertools.count()
+
+
+class _Compiler(object):
+    # language=rst
+    """Generates the source of a canonicalizer function.
+
+    Types emit the statements that canonicalize the value of one local variable
+    into another through :meth:`Type._emit_canonicalize`. Anything that can't
+    be expressed as a literal in the source is passed to the generated function
+    through its globals.
+
+    """
+
+    def __init__(self):
+        self.lines: T.List[str] = []
+        self.namespace: T.Dict[str, T.Any] = {}
+        self.indentation = 1
+        self.objects: T.List['Object'] = []
+        self.fields: T.Optional[Projection] = None
+        self._counter = itertools.count()
+
+    def variable(self) -> str:
+        return '_v{}'.format(next(self._counter))
+
+    def constant(self, value: T.Any) -> str:
+        name = '_c{}'.format(next(self._counter))
+        self.namespace[name] = value
+        return name
+
+    def line(self, line: str):
+        self.lines.append('    ' * self.indentation + line)
+
+    def indent(self):
+        self.indentation += 1
+
+    def dedent(self):
+        self.indentation -= 1
+
+    def emit(self, type_: 'Type', value: str, target: str,
+             fields: T.Optional[Projection]=None):
+        # A subclass that overrides canonicalize() without also overriding
+        # _emit_canonicalize() is called instead of inlined:
+        canonicalize = next(
+            cls for cls in type(type_).__mro__ if 'canonicalize' in vars(cls)
+        )
+        emit = next(
+            cls for cls in type(type_).__mro__ if '_emit_canonicalize' in vars(cls)
+        )
+        if canonicalize is not emit or type_ in self.objects:
+            if fields is not None and isinstance(type_, Object):
+                self.line('{} = {}.canonicalize({}, {})'.format(
+                    target, self.constant(type_), value, self.constant(fields)
+                ))
+            else:
+                self.line('{} = {}.canonicalize({})'.format(
+                    target, self.constant(type_), value
+                ))
+        else:
+            # The projection that applies to type_:
+            self.fields = fields
+            type_._emit_canonicalize(self, value, target)
+
+    def function(self, name: str) -> T.Callable[[T.Any], T.Any]:
+        source = '\n'.join(['def {}(value):'.format(name)] + self.lines) + '\n'
+        filename = '<{} {}>'.format(name, next(_compilations))
+        # Makes the generated source show up in tracebacks:
+        linecache.cache[filename] = (
+            len(source), None, source.splitlines(keepends=True), filename
+        )
+        namespace = dict(self.namespace)
+        exec(compile(source, filename, 'exec'), namespace)
+        return namespace[name]
+
+
+def _projection_key(fields: T.Optional[Projection]) -> T.Optional[tuple]:
+    # language=rst
+    """A hashable equivalent of ``fields``."""
+    if fields is None:
+        return None
+    return tuple(sorted(
+        (name, _projection_key(value)) for name, value in fields.items()
+    ))
+
 
 class Type(object):
     def __init__(self, *args,
@@ -44,6 +149,7 @@ class Type(object):
         self.format = format
         assert isinstance(read_only, bool)
         self.read_only = read_only
+        self._validators: T.Dict[str, T.Tuple[int, T.Any]] = {}
 
     def schema(self, method: str) -> dict:
         retval = {}
@@ -71,14 +177,49 @@ class Type(object):
         :returns: the Type for which validation succeeded. See also
             :meth:`OneOf.validate`
         :rtype: Type
+        :raises jsonschema.ValidationError: the best matching error, as
+            :func:`jsonschema.validate` would raise it.
 
         """
-        jsonschema.validate(data, self.schema(method))
+        error = jsonschema.exceptions.best_match(
+            self.validator(method).iter_errors(data)
+        )
+        if error is not None:
+            raise error
         return self
 
+    def validator(self, method: str):
+        # language=rst
+        """The JSON Schema validator for ``method``.
+
+        The validator class is chosen, and the schema is checked, only once per
+        method. The validator is cached until a property is added to any
+        :class:`Object`, because that may change the schema of this type.
+
+        """
+        cached = self._validators.get(method)
+        if cached is None or cached[0] != _current_generation:
+            schema = self.schema(method)
+            cls = jsonschema.validators.validator_for(schema)
+            cls.check_schema(schema)
+            cached = (_current_generation, cls(schema))
+            self._validators[method] = cached
+        return cached[1]
+
     def canonicalize(self, value: T.Any):
         return value
 
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        # language=rst
+        """Emit the statements of :meth:`canonicalize`.
+
+        :param c: the compiler to emit to.
+        :param value: name of the variable that holds the value.
+        :param target: name of the variable to assign the result to.
+
+        """
+        c.line('{} = {}'.format(target, value))
+
 
 class List(Type):
     def __init__(self,
@@ -125,6 +266,30 @@ class List(Type):
                 retval.append(v)
         return retval
 
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        fields = c.fields
+        datum, v = c.variable(), c.variable()
+        c.line('if {} is None:'.format(value))
+        c.indent()
+        c.line('{} = None'.format(target))
+        c.dedent()
+        c.line('elif not isinstance({}, list):'.format(value))
+        c.indent()
+        c.line('raise TypeError("{{}}: not a list".format({}))'.format(value))
+        c.dedent()
+        c.line('else:')
+        c.indent()
+        c.line('{} = []'.format(target))
+        c.line('for {} in {}:'.format(datum, value))
+        c.indent()
+        c.emit(self.item_type, datum, v, fields)
+        c.line('if {} is not None:'.format(v))
+        c.indent()
+        c.line('{}.append({})'.format(target, v))
+        c.dedent()
+        c.dedent()
+        c.dedent()
+
     def full_text_search_representation(self, data: T.Iterable, prop_filter:set):
         """We must check whether the given data is really a list, jsonld may
         flatten lists."""
@@ -169,6 +334,8 @@ class Object(Type):
         assert format is None
         super().__init__(*args, **kwargs)
         self.properties: T.List[T.Tuple[str, Type]] = []
+        self._canonicalizers: T.Dict[T.Any, T.Tuple[int, T.Callable]] = {}
+        self._schemas: T.Dict[str, T.Tuple[int, dict]] = {}
 
     @property
     def property_names(self):
@@ -181,8 +348,12 @@ class Object(Type):
         raise KeyError()
 
     def add(self, name, value, before=None):
+        global _current_generation
         if name in self.property_names:
             raise ValueError()
+        # Compiled canonicalizers inline nested objects, so this may
+        # invalidate the canonicalizers of other objects as well:
+        _current_generation = next(_schema_generation)
         property = (name, value)
         if before is None:
             self.properties.append(property)
@@ -192,6 +363,21 @@ class Object(Type):
         return self
 
     def schema(self, method: str) -> dict:
+        # language=rst
+        """The JSON Schema of this object for ``method``.
+
+        The schema is cached until a property is added to any object. The
+        result is shared by all callers, so it must not be modified; make a
+        deep copy first.
+
+        """
+        cached = self._schemas.get(method)
+        if cached is None or cached[0] != _current_generation:
+            cached = (_current_generation, self._schema(method))
+            self._schemas[method] = cached
+        return cached[1]
+
+    def _schema(self, method: str) -> dict:
         retval = dict(super().schema(method))  # Important: makes a shallow copy
         # Also show read_only properties in the frontend because they ned to be shown
         # TODO : In frontend use read_only flag in schema to make properties readonly
@@ -223,20 +409,71 @@ class Object(Type):
         retval = '\n\n'.join(v for v in ftsr if v is not None)
         return retval if len(retval) > 0 else None
 
-    def canonicalize(self, value: T.Optional[dict]):
-        value = super().canonicalize(value)
-        if value is None:
-            return None
-        if not isinstance(value, dict):
-            raise TypeError("{}: not a dict".format(value))
-        retval = {}
+    def canonicalize(self, value: T.Optional[dict], fields: T.Optional[Projection]=None):
+        # language=rst
+        """Canonicalize ``value`` with the compiled :meth:`canonicalizer`.
+
+        :param fields: if given, only the selected properties are canonicalized
+            and returned.
+
+        """
+        return self.canonicalizer(fields)(value)
+
+    def canonicalizer(self, fields: T.Optional[Projection]=None) \
+            -> T.Callable[[T.Optional[dict]], T.Optional[dict]]:
+        # language=rst
+        """A function that canonicalizes values of this type.
+
+        The whole tree of types below this object (or the part of it selected
+        by ``fields``) is flattened into the source of a single Python function,
+        so that canonicalization doesn't have to walk the tree on every call.
+        The function is compiled once per projection and cached until a
+        property is added to any object.
+
+        """
+        key = _projection_key(fields)
+        cached = self._canonicalizers.get(key)
+        if cached is None or cached[0] != _current_generation:
+            c = _Compiler()
+            c.emit(self, 'value', 'retval', fields)
+            c.line('return retval')
+            cached = (_current_generation, c.function('canonicalize_object'))
+            if key not in self._canonicalizers and \
+                    len(self._canonicalizers) >= _MAX_CANONICALIZERS:
+                # Forget the oldest projection:
+                del self._canonicalizers[next(iter(self._canonicalizers))]
+            self._canonicalizers[key] = cached
+        return cached[1]
+
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        fields = c.fields
+        c.objects.append(self)
+        c.line('if {} is None:'.format(value))
+        c.indent()
+        c.line('{} = None'.format(target))
+        c.dedent()
+        c.line('elif not isinstance({}, dict):'.format(value))
+        c.indent()
+        c.line('raise TypeError("{{}}: not a dict".format({}))'.format(value))
+        c.dedent()
+        c.line('else:')
+        c.indent()
+        c.line('{} = {{}}'.format(target))
         for key, type_ in self.properties:
-            if key not in value:
+            if fields is not None and key not in fields:
                 continue
-            v = type_.canonicalize(value[key])
-            if v is not None:
-                retval[key] = v
-        return retval
+            datum, v = c.variable(), c.variable()
+            c.line('if {!r} in {}:'.format(key, value))
+            c.indent()
+            c.line('{} = {}[{!r}]'.format(datum, value, key))
+            c.emit(type_, datum, v, None if fields is None else fields[key])
+            c.line('if {} is not None:'.format(v))
+            c.indent()
+            c.line('{}[{!r}] = {}'.format(target, key, v))
+            c.dedent()
+            c.dedent()
+        c.dedent()
+        c.objects.pop()
 
     def set_required_values(self, object_: dict) -> dict:
         # language=rst
@@ -245,14 +482,22 @@ class Object(Type):
         returned to the user.
 
         :param object_: The object about to be returned to the user.
-        :return: ``object_`` with required values added.
+        :return: ``object_`` with required values added. This is a shallow
+            copy of ``object_`` if anything was added, and ``object_`` itself
+            otherwise.
         """
-        retval = dict(object_)  # Important. Makes a shallow copy.
+        retval = object_
         for key, type_ in self.properties:
+            value = retval.get(key)
             if type_.required is not None and key not in retval:
-                retval[key] = type_.required
-            if isinstance(type_, Object) and key in retval:
-                retval[key] = type_.set_required_values(retval[key])
+                value = type_.required
+            if isinstance(type_, Object) and value is not None:
+                value = type_.set_required_values(value)
+            if key in retval and value is retval[key] or key not in retval and value is None:
+                continue
+            if retval is object_:
+                retval = dict(object_)  # Copy on write.
+            retval[key] = value
         return retval
 
 
@@ -289,6 +534,25 @@ class String(Type):
             value = None
         return value
 
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        c.line('if {} is None:'.format(value))
+        c.indent()
+        c.line('{} = None'.format(target))
+        c.dedent()
+        c.line('elif not isinstance({}, str):'.format(value))
+        c.indent()
+        c.line('raise TypeError("{{}}: not a string".format(repr({})))'.format(value))
+        c.dedent()
+        c.line('else:')
+        c.indent()
+        c.line("{} = {}.strip().replace('\\r\\n', '\\n')".format(target, value))
+        if not self.allow_empty:
+            c.line('if len({}) == 0:'.format(target))
+            c.indent()
+            c.line('{} = None'.format(target))
+            c.dedent()
+        c.dedent()
+
 
 class PlainTextLine(String):
     def __init__(self, *args, pattern=None, **kwargs):
@@ -312,6 +576,13 @@ class Date(String):
             raise TypeError("{}: not a string".format(repr(value)))
         return value[:10]
 
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        super()._emit_canonicalize(c, value, target)
+        c.line('if {} is not None:'.format(target))
+        c.indent()
+        c.line('{0} = {0}[:10]'.format(target))
+        c.dedent()
+
 
 class Language(String):
     def __init__(self, *args, format=None, pattern=None, **kwargs):
@@ -376,3 +647,21 @@ class Integer(Type):
                 raise ValueError("{}: not an integer".format(value))
             return retval
         raise TypeError("{}: not an integer".format(value))
+
+    def _emit_canonicalize(self, c: _Compiler, value: str, target: str):
+        c.line('if {} is None or isinstance({}, int):'.format(value, value))
+        c.indent()
+        c.line('{} = {}'.format(target, value))
+        c.dedent()
+        c.line('elif isinstance({}, str):'.format(value))
+        c.indent()
+        c.line('{} = int({}.strip())'.format(target, value))
+        c.line('if len(str({})) != len({}):'.format(target, value))
+        c.indent()
+        c.line('raise ValueError("{{}}: not an integer".format({}))'.format(value))
+        c.dedent()
+        c.dedent()
+        c.line('else:')
+        c.indent()
+        c.line('raise TypeError("{{}}: not an integer".format({}))'.format(value))
+        c.dedent()
@@ -9,7 +9,8 @@ import json
 import time
 from urllib.parse import urljoin
 
-from datacatalog.plugins.postgres import _etag_from_str
+from datacatalog.plugins.postgres import _etag_from_str, _stored_facets, _update_doc_facets, \
+    _Q_CLEAR_RENDITION, _Q_LOCK_DOC
 
 MAX_REQUESTS = 10
 MAX_REDIRECTS = 5
@@ -30,11 +31,19 @@ async def storage_all(con):
 
 
 async def update_doc(con, id, doc):
-    _Q_UPDATE_DOC = 'UPDATE "dataset" SET doc=$1, etag=$2 WHERE id=$3 RETURNING id'
+    _Q_UPDATE_DOC = 'UPDATE "dataset" SET doc=$1, etag=$2, ' + _Q_CLEAR_RENDITION + ' WHERE id=$3 RETURNING id'
     new_doc = json.dumps(doc, ensure_ascii=False, sort_keys=True)
     new_etag = _etag_from_str(new_doc)
     async with con.transaction():
+        # Lock the row like storage_update does, so that a concurrent write
+        # can't change it between the facet updates:
+        if await con.fetchval(_Q_LOCK_DOC, id) is None:
+            return None
+        # Keep the facet counts of the running service up to date:
+        facets = await _stored_facets(con)
+        await _update_doc_facets(con, facets, [id], -1)
         await con.execute(_Q_UPDATE_DOC, new_doc, new_etag, id);
+        await _update_doc_facets(con, facets, [id], 1)
     return new_etag
 
 
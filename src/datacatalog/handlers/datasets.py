@@ -1,3 +1,5 @@
+import base64
+import binascii
 import csv
 import json.decoder
 import logging
@@ -5,10 +7,14 @@ import re
 import typing as T
 
 from aiohttp import web
+import jsonschema
+from yarl import URL
 
 from aiohttp_extras import conditional
 from aiohttp_extras.content_negotiation import produces_content_types
 
+from datacatalog import dcat, rendering, singleflight
+
 
 _logger = logging.getLogger(__name__)
 
@@ -18,6 +24,9 @@ _FACET_QUERY_KEY = re.compile(
 _FACET_QUERY_VALUE = re.compile(
     r'(in|eq|gt|lt|ge|le)=(.*)', flags=re.S
 )
+_DOCID = re.compile(r"(?:%[a-f0-9]{2}|[-\w:@!$&'()*+,;=.~])+")
+# Number of lines of a bulk request that are stored in one go:
+_BULK_BATCH_SIZE = 100
 
 
 @produces_content_types('application/ld+json', 'application/json')
@@ -32,26 +41,80 @@ async def get(request: web.Request):
             body='Endpoint does not support * in the If-None-Match header.'
         )
     # Now we know etag_if_none_match is either None or a set.
+    # Concurrent requests for the same dataset share the storage reads and the
+    # rendering, so canonical_doc must not be modified.
+    flights: singleflight.Group = request.app['dataset_flights']
+    body_cache: rendering.BodyCache = request.app['body_cache']
+    version = request.app['render_version']
+    cached = body_cache.get(docid, version)
+    canonical_doc = None
     try:
-        doc, etag = await hooks.storage_retrieve(
-            app=request.app, docid=docid, etags=etag_if_none_match
-        )
+        if cached is not None:
+            # The cached body is current if the etag is:
+            etag = await flights.do(('etag', docid), _retrieve_etag, request.app, docid)
+            if etag != cached.etag:
+                cached = None
+        if cached is None:
+            canonical_doc, etag = await flights.do(
+                ('rendition', docid), _retrieve_rendition, request.app, docid
+            )
     except KeyError:
+        body_cache.discard(docid)
         raise web.HTTPNotFound()
-    if doc is None:
+    if etag_if_none_match is not None and \
+            conditional.match_etags(etag, etag_if_none_match, True):
         return web.Response(status=304, headers={'Etag': etag})
-    canonical_doc = await hooks.mds_canonicalize(app=request.app, data=doc)
-    canonical_doc = await hooks.mds_after_storage(app=request.app, data=canonical_doc, doc_id=docid)
-
-    if canonical_doc['ams:status'] not in ('beschikbaar', 'in_onderzoek'):
+    if cached is None:
+        if canonical_doc is None:
+            # No (current) rendition; render the document and keep the result.
+            try:
+                canonical_doc, etag = await flights.do(
+                    ('render', docid), _render, request.app, docid
+                )
+            except KeyError:
+                raise web.HTTPNotFound()
+        # Another request in the same flight may have serialized it already:
+        cached = body_cache.get(docid, version)
+        if cached is None or cached.etag != etag:
+            cached = body_cache.put(docid, etag, version, canonical_doc)
+
+    if cached.status not in ('beschikbaar', 'in_onderzoek'):
         scopes = request.authz_scopes if hasattr(request, "authz_scopes") else {}
         extra_read_access = 'CAT/R' in scopes
         if not extra_read_access:
             return web.HTTPForbidden()
 
-    return web.json_response(canonical_doc, headers={
-        'Etag': etag, 'content_type': 'application/ld+json'
-    })
+    return web.Response(
+        body=cached.body, content_type='application/json', charset='utf-8',
+        headers={'Etag': etag, 'content_type': 'application/ld+json'}
+    )
+
+
+async def _retrieve_etag(app: web.Application, docid: str) -> str:
+    return await app.hooks.storage_etag(app=app, docid=docid)
+
+
+async def _retrieve_rendition(app: web.Application, docid: str) \
+        -> T.Tuple[T.Optional[dict], str]:
+    return await app.hooks.storage_retrieve_rendition(
+        app=app, docid=docid, version=app['render_version']
+    )
+
+
+async def _render(app: web.Application, docid: str) -> T.Tuple[dict, str]:
+    doc, etag = await app.hooks.storage_retrieve(app=app, docid=docid, etags=None)
+    return await rendering.store(app, docid, etag, doc), etag
+
+
+def _forget(app: web.Application, *docids: str):
+    # A read that starts after a write must not share the result of a read
+    # that started before it:
+    flights: singleflight.Group = app['dataset_flights']
+    for docid in docids:
+        for stage in ('etag', 'rendition', 'render'):
+            flights.forget((stage, docid))
+        app['body_cache'].discard(docid)
+    app.hooks.mds_after_write(app=app, docids=list(docids))
 
 
 async def put(request: web.Request):
@@ -120,6 +183,8 @@ async def put(request: web.Request):
             )
         except ValueError:
             raise web.HTTPPreconditionFailed()
+        _forget(request.app, doc_id)
+        await rendering.store(request.app, doc_id, new_etag, canonical_doc)
         retval = web.Response(status=204, headers={'Etag': new_etag})
 
     else:
@@ -138,6 +203,8 @@ async def put(request: web.Request):
             )
         except KeyError:
             raise web.HTTPPreconditionFailed()
+        _forget(request.app, doc_id)
+        await rendering.store(request.app, doc_id, new_etag, canonical_doc)
         retval = web.Response(
             status=201, headers={'Etag': new_etag}, content_type='text/plain'
         )
@@ -157,6 +224,7 @@ async def delete(request: web.Request):
             app=request.app, docid=given_id, etags=etag_if_match)
     except KeyError:
         raise web.HTTPNotFound()
+    _forget(request.app, given_id)
     return web.Response(status=204, content_type='text/plain')
 
 
@@ -214,6 +282,10 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
             raise web.HTTPBadRequest(
                 text="Invalid limit value %s" % limit
             )
+        if limit < 0:
+            raise web.HTTPBadRequest(
+                text="Invalid limit value %s" % limit
+            )
     offset = query.get('offset', 0)
     if offset is not None:
         try:
@@ -222,6 +294,29 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
             raise web.HTTPBadRequest(
                 text="Invalid offset value %s" % offset
             )
+        if offset < 0:
+            raise web.HTTPBadRequest(
+                text="Invalid offset value %s" % offset
+            )
+
+    cursor = query.get('cursor')
+    after = None
+    if cursor is not None:
+        if len(full_text_query) > 0:
+            raise web.HTTPBadRequest(
+                text="Parameter cursor can't be combined with a query"
+            )
+        if 'offset' in query:
+            raise web.HTTPBadRequest(
+                text="Parameter cursor can't be combined with offset"
+            )
+        after = _decode_cursor(cursor)
+        if after is None:
+            raise web.HTTPBadRequest(
+                text="Invalid cursor value %s" % cursor
+            )
+
+    fields = await fields_parameter(request)
 
     result_info = {}
     facets = [
@@ -241,8 +336,12 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
         sortpath=['ams:sort_modified'],
         result_info=result_info,
         facets=facets,
-        limit=limit, offset=offset,
-        filters=filters, iso_639_1_code='nl'
+        limit=limit, offset=offset, after=after,
+        filters=filters, iso_639_1_code='nl', summary=fields is None,
+        render_version=request.app['render_version'],
+        fields=None if fields is None else list(fields),
+        # The sort key of the last result is needed for the pagination link:
+        sort_key=True
     )
 
     ctx = await hooks.mds_context()
@@ -257,23 +356,23 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
     await response.write(ctx_json.encode())
     await response.write(b',"dcat:dataset":[')
 
-    async for docid, doc in resultiterator:
-        canonical_doc = await hooks.mds_canonicalize(app=request.app, data=doc)
-        canonical_doc = await hooks.mds_after_storage(app=request.app, data=canonical_doc, doc_id=docid)
-        keepers = {'@id', 'dct:identifier', 'dct:title', 'dct:description',
-                   'dcat:keyword', 'foaf:isPrimaryTopicOf', 'dcat:distribution',
-                   'dcat:theme', 'ams:owner', 'ams:sort_modified'}
-        if extra_read_access:
-            keepers.add('ams:status')
-        for key in list(canonical_doc.keys()):
-            if key not in keepers:
-                del canonical_doc[key]
-        keepers = {'dcat:mediaType', 'ams:resourceType', 'ams:distributionType',
-                   'ams:serviceType', 'dc:identifier'}
-        for d in canonical_doc.get('dcat:distribution', []):
-            for key in list(d.keys()):
-                if key not in keepers:
-                    del d[key]
+    row_count = 0
+    last_sort_key = None
+    renditions = rendering.render_missing(
+        request.app, resultiterator, rendering.union(rendering.SUMMARY_FIELDS, fields)
+    )
+    async for docid, doc, canonical_doc, sort_key in renditions:
+        row_count += 1
+        # The sort value as the storage plugin sees it, which may differ from
+        # the rendered ams:sort_modified:
+        last_sort_key = (sort_key, docid)
+        if doc is not None and fields is None:
+            # Rendered just now, so not summarized yet:
+            canonical_doc = rendering.summarize(canonical_doc)
+        if fields is not None:
+            canonical_doc = rendering.project(canonical_doc, fields)
+        if not extra_read_access:
+            canonical_doc.pop('ams:status', None)
         if not first:
             await response.write(b',')
         else:
@@ -281,6 +380,14 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
         await response.write(json.dumps(canonical_doc).encode())
 
     await response.write(b']')
+    # Offer a keyset pagination link if this listing has a full page:
+    if len(full_text_query) == 0 and limit is not None and row_count == limit > 0:
+        next_query = query.copy()
+        next_query.pop('offset', None)
+        next_query['cursor'] = _encode_cursor(last_sort_key)
+        next_url = URL(_datasets_url(request)).with_query(next_query)
+        await response.write(b', "ams:next": ')
+        await response.write(json.dumps(str(next_url)).encode())
     await response.write(b', "void:documents": ')
     await response.write(str(result_info['/']).encode())
     del result_info['/']
@@ -291,6 +398,22 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
     return response
 
 
+async def fields_parameter(request: web.Request) -> T.Optional[dcat.Projection]:
+    # language=rst
+    """The projection in the ``fields`` query parameter, if any.
+
+    :raises web.HTTPBadRequest: if the parameter selects unknown properties.
+
+    """
+    if 'fields' not in request.query:
+        return None
+    schema = await request.app.hooks.mds_json_schema(app=request.app, method='GET')
+    try:
+        return rendering.parse_fields(request.query['fields'], schema)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+
+
 async def link_redirect(request: web.Request):
     dataset = request.match_info['dataset']
     distribution = request.match_info['distribution']
@@ -341,7 +464,7 @@ async def post_collection(request: web.Request):
 
     docid = canonical_doc.get('dct:identifier')
     if docid is not None:
-        if not re.fullmatch(r"(?:%[a-f0-9]{2}|[-\w:@!$&'()*+,;=.~])+", docid):
+        if not _DOCID.fullmatch(docid):
             raise web.HTTPBadRequest(
                 text="Illegal value for dct:identifier"
             )
@@ -363,6 +486,8 @@ async def post_collection(request: web.Request):
         raise web.HTTPBadRequest(
             text='Document with dct:identifier {} already exists'.format(docid)
         )
+    _forget(request.app, docid)
+    await rendering.store(request.app, docid, new_etag, canonical_doc)
     return web.Response(
         status=201, headers={
             'Etag': new_etag,
@@ -372,10 +497,215 @@ async def post_collection(request: web.Request):
     )
 
 
+async def post_bulk(request: web.Request):
+    # language=rst
+    """Create or update many datasets from one newline-delimited JSON body.
+
+    Each line of the body is an object ``{"id": ..., "ifMatch": ..., "doc":
+    {...}}``. A line with ``ifMatch`` (an Etag or a list of Etags) updates the
+    dataset ``id``, like ``PUT`` with ``If-Match``. Other lines create a new
+    dataset, like ``PUT`` with ``If-None-Match: *``, or like ``POST`` if there
+    is no ``id``.
+
+    The lines are processed in batches and the response streams one result
+    object per line, in the order of the request.
+
+    """
+    if request.content_type != 'application/x-ndjson':
+        raise web.HTTPUnsupportedMediaType(text='Expected application/x-ndjson')
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+    batch = []
+    async for line in _ndjson_lines(request.content):
+        batch.append(line)
+        if len(batch) == _BULK_BATCH_SIZE:
+            await _write_bulk_results(response, await _store_bulk_batch(request, batch))
+            batch = []
+    if len(batch) > 0:
+        await _write_bulk_results(response, await _store_bulk_batch(request, batch))
+    await response.write_eof()
+    return response
+
+
+async def _ndjson_lines(stream) -> T.AsyncGenerator[T.Tuple[int, bytes], None]:
+    # StreamReader.readline() has a line length limit which a large dataset
+    # could exceed, so the lines are split here.
+    lineno = 0
+    buffer = bytearray()
+    async for chunk in stream.iter_any():
+        buffer.extend(chunk)
+        *lines, rest = buffer.split(b'\n')
+        buffer = bytearray(rest)
+        for line in lines:
+            lineno += 1
+            if line.strip():
+                yield lineno, bytes(line)
+    lineno += 1
+    if buffer.strip():
+        yield lineno, bytes(buffer)
+
+
+# Errors of the metadata plugin hooks that mean that a dataset is invalid:
+_INVALID_DATASET_ERRORS = (jsonschema.ValidationError, ValueError, TypeError)
+
+
+async def _store_bulk_batch(request: web.Request,
+                            batch: T.List[T.Tuple[int, bytes]]) -> T.List[dict]:
+    hooks = request.app.hooks
+    is_redact_only = 'CAT/W' not in request.authz_scopes
+    results = {}
+    creates = []
+    updates = []
+    for lineno, line in batch:
+        try:
+            envelope = json.loads(line)
+        except ValueError:
+            results[lineno] = _bulk_error(lineno, None, 400, 'invalid json')
+            continue
+        if not isinstance(envelope, dict) or not isinstance(envelope.get('doc'), dict):
+            results[lineno] = _bulk_error(lineno, None, 400, 'expected an object with a "doc"')
+            continue
+        docid = envelope.get('id')
+        if docid is not None and (not isinstance(docid, str) or not _DOCID.fullmatch(docid)):
+            results[lineno] = _bulk_error(lineno, None, 400, 'illegal value for id')
+            continue
+        etags = envelope.get('ifMatch')
+        if isinstance(etags, str):
+            etags = {etags}
+        elif isinstance(etags, list) and len(etags) > 0 and all(isinstance(e, str) for e in etags):
+            etags = set(etags)
+        elif etags is not None:
+            results[lineno] = _bulk_error(lineno, docid, 400, 'illegal value for ifMatch')
+            continue
+        if etags is not None and docid is None:
+            results[lineno] = _bulk_error(lineno, None, 400, 'ifMatch requires an id')
+            continue
+
+        doc = envelope['doc']
+        doc['ams:modifiedby'] = request.authz_subject
+        try:
+            canonical_doc = await hooks.mds_canonicalize(app=request.app, data=doc)
+        except _INVALID_DATASET_ERRORS:
+            # The response is already streaming, so an invalid line must not
+            # abort the batch. Other errors, like storage failures, do.
+            _logger.debug("Invalid dataset on line %d", lineno, exc_info=True)
+            results[lineno] = _bulk_error(lineno, docid, 400, 'invalid dataset')
+            continue
+        if is_redact_only and canonical_doc.get('ams:status') == 'beschikbaar':
+            results[lineno] = _bulk_error(lineno, docid, 403, 'forbidden')
+            continue
+        if docid is None:
+            # Like POST /datasets:
+            docid = canonical_doc.get('dct:identifier')
+            if docid is not None:
+                if not isinstance(docid, str) or not _DOCID.fullmatch(docid):
+                    results[lineno] = _bulk_error(lineno, None, 400, 'illegal value for dct:identifier')
+                    continue
+                del canonical_doc['dct:identifier']
+            else:
+                docid = await hooks.storage_id()
+
+        if etags is None:
+            creates.append((lineno, docid, canonical_doc))
+        else:
+            updates.append((lineno, docid, canonical_doc, etags))
+
+    old_docs = {}
+    if len(updates) > 0:
+        old_docs = await hooks.storage_retrieve_many(
+            app=request.app, docids=list({docid for lineno, docid, doc, etags in updates})
+        )
+    prepared_creates = []
+    prepared_updates = []
+    for lineno, docid, canonical_doc, etags in \
+            [(lineno, docid, doc, None) for lineno, docid, doc in creates] + updates:
+        if etags is not None and docid not in old_docs:
+            results[lineno] = _bulk_error(lineno, docid, 412, 'precondition failed')
+            continue
+        try:
+            if etags is None:
+                canonical_doc = await hooks.mds_before_storage(
+                    app=request.app, data=canonical_doc
+                )
+            else:
+                canonical_doc = await hooks.mds_before_storage(
+                    app=request.app, data=canonical_doc, old_data=old_docs[docid][0]
+                )
+            searchable_text = await hooks.mds_full_text_search_representation(
+                data=canonical_doc
+            )
+        except _INVALID_DATASET_ERRORS:
+            _logger.debug("Invalid dataset on line %d", lineno, exc_info=True)
+            results[lineno] = _bulk_error(lineno, docid, 400, 'invalid dataset')
+            continue
+        if etags is None:
+            prepared_creates.append((lineno, docid, canonical_doc, searchable_text))
+        else:
+            prepared_updates.append((lineno, docid, canonical_doc, searchable_text, etags))
+
+    stored_docs = []
+    if len(prepared_creates) > 0:
+        stored = await hooks.storage_create_many(app=request.app, docs=[
+            (docid, doc, searchable_text, "nl")
+            for lineno, docid, doc, searchable_text in prepared_creates
+        ])
+        for (lineno, docid, doc, searchable_text), result in zip(prepared_creates, stored):
+            if isinstance(result, str):
+                stored_docs.append((docid, result, doc))
+                results[lineno] = {'line': lineno, 'id': docid, 'status': 201, 'etag': result}
+            else:
+                results[lineno] = _bulk_error(lineno, docid, 412, 'already exists')
+    if len(prepared_updates) > 0:
+        stored = await hooks.storage_update_many(app=request.app, docs=[
+            (docid, doc, searchable_text, etags, "nl")
+            for lineno, docid, doc, searchable_text, etags in prepared_updates
+        ])
+        for (lineno, docid, doc, searchable_text, etags), result in zip(prepared_updates, stored):
+            if isinstance(result, str):
+                stored_docs.append((docid, result, doc))
+                results[lineno] = {'line': lineno, 'id': docid, 'status': 204, 'etag': result}
+            else:
+                results[lineno] = _bulk_error(lineno, docid, 412, 'precondition failed')
+    if len(stored_docs) > 0:
+        _forget(request.app, *[docid for docid, etag, doc in stored_docs])
+    await rendering.store_many(request.app, stored_docs)
+    return [results[lineno] for lineno, line in batch]
+
+
+def _bulk_error(lineno: int, docid: T.Optional[str], status: int, error: str) -> dict:
+    return {'line': lineno, 'id': docid, 'status': status, 'error': error}
+
+
+async def _write_bulk_results(response: web.StreamResponse, results: T.List[dict]):
+    await response.write(''.join(
+        json.dumps(result, ensure_ascii=False) + '\n' for result in results
+    ).encode())
+
+
 def _datasets_url(request: web.Request) -> str:
     return request.app.config['web']['baseurl'] + 'datasets'
 
 
+def _encode_cursor(sort_key: T.Tuple[str, str]) -> str:
+    # language=rst
+    """Opaque keyset pagination token for the given (sort value, id)."""
+    cursor = json.dumps(list(sort_key), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(cursor).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: str) -> T.Optional[T.Tuple[str, str]]:
+    try:
+        sort_key = json.loads(base64.urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)
+        ))
+    except (binascii.Error, ValueError):
+        return None
+    if not isinstance(sort_key, list) or len(sort_key) != 2 or \
+            not all(isinstance(v, str) for v in sort_key):
+        return None
+    return sort_key[0], sort_key[1]
+
+
 def _csv_decode_line(s: str) -> T.Optional[T.Set[str]]:
     reader = csv.reader([s])
     try:
@@ -8,6 +8,9 @@ from aiohttp import web
 
 from aiohttp_extras.content_negotiation import produces_content_types
 
+from datacatalog import rendering
+from .datasets import fields_parameter
+
 
 # logger = logging.getLogger(__name__ )
 
@@ -29,12 +32,15 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
             }
         }
 
+    fields = await fields_parameter(request)
     result_info = {}
     dataset_iterator = await hooks.search_search(
         app=request.app, q='',
         sortpath=['ams:sort_modified'],
         result_info=result_info,
-        filters=filters, iso_639_1_code='nl'
+        filters=filters, iso_639_1_code='nl',
+        render_version=request.app['render_version'],
+        fields=None if fields is None else list(fields)
     )
 
     ctx = await hooks.mds_context()
@@ -49,10 +55,14 @@ async def get_collection(request: web.Request) -> web.StreamResponse:
     await response.write(b',"dcat:dataset":[')
 
     separator = b''
-    async for docid, doc in dataset_iterator:
-        canonical_doc = await hooks.mds_canonicalize(app=request.app, data=doc)
-        canonical_doc = await hooks.mds_after_storage(app=request.app, data=canonical_doc, doc_id=docid)
-        del canonical_doc['@context']
+    renditions = rendering.render_missing(
+        request.app, dataset_iterator,
+        None if fields is None else rendering.union(rendering.SUMMARY_FIELDS, fields)
+    )
+    async for docid, doc, canonical_doc in renditions:
+        canonical_doc.pop('@context', None)
+        if fields is not None:
+            canonical_doc = rendering.project(canonical_doc, fields)
         await response.write(separator + json.dumps(canonical_doc).encode())
         separator = b','
 
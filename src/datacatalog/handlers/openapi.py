@@ -1,31 +1,118 @@
+import collections
 import copy
+import gzip
+import hashlib
 import json
+import re
+import typing as T
 
 from aiohttp import web
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+from aiohttp_extras import conditional
 from aiohttp_extras.content_negotiation import produces_content_types
 
+_Representations = collections.namedtuple(
+    '_Representations', 'openapi json_schema baseurl etag bodies'
+)
+# The representations of the most recently served definition. The objects it
+# was built from are kept, so that they can be compared by identity:
+_cache: T.Optional[_Representations] = None
+
+_ACCEPT_ENCODING_PATTERN = re.compile(
+    r'\s*([\w*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+)\s*)?'
+)
+
+
+def _representations(openapi: dict, json_schema: dict, baseurl: str) -> _Representations:
+    # language=rst
+    """The serialized definition, and its compressed encodings.
+
+    These are rebuilt only if the definition, the dataset schema (which carries
+    the example values) or the base URL is another object than last time.
+
+    """
+    global _cache
+    if _cache is not None and _cache.openapi is openapi and \
+            _cache.json_schema is json_schema and _cache.baseurl == baseurl:
+        return _cache
+    openapi_schema = copy.deepcopy(openapi)
+    # For backward compatibility: the front-end looks at this path:
+    openapi_schema['components']['schemas']['dcat-dataset'] = json_schema
+    # add base url to servers
+    openapi_schema['servers'] = [{'url': baseurl}]
+    body = json.dumps(openapi_schema, indent='  ', sort_keys=True).encode()
+    bodies = {
+        'identity': body,
+        'gzip': gzip.compress(body)
+    }
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    _cache = _Representations(
+        openapi=openapi, json_schema=json_schema, baseurl=baseurl,
+        etag=hashlib.sha1(body).hexdigest(), bodies=bodies
+    )
+    return _cache
+
+
+def _content_encoding(request: web.Request, available: T.Iterable[str]) -> str:
+    # language=rst
+    """The best of the ``available`` encodings that the client accepts."""
+    accepted = {}
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        match = _ACCEPT_ENCODING_PATTERN.fullmatch(item)
+        if match is None:
+            continue
+        try:
+            accepted[match[1].lower()] = float(match[2] or 1)
+        except ValueError:
+            continue
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
 
 @produces_content_types('application/ld+json', 'application/json')
 async def get(request: web.Request):
     # language=rst
-    """Produce the OpenAPI3 definition of this service."""
-    openapi_schema = copy.deepcopy(request.app['openapi'])
-    c = request.app.config
+    """Produce the OpenAPI3 definition of this service.
+
+    The definition is serialized and compressed once, and served with a strong
+    ETag per content encoding.
+
+    """
+    etag_if_none_match = conditional.parse_if_header(
+        request, conditional.HEADER_IF_NONE_MATCH
+    )
     # add document schema
-    json_schema = {}
-    for method in ['PUT']:
-        json_schema[method] = await request.app.hooks.mds_json_schema(
-            app=request.app,
-            method=method
-        )
-    # For backward compatibility: the front-end looks at this path:
-    openapi_schema['components']['schemas']['dcat-dataset'] = json_schema['PUT']
-    # add base url to servers
-    openapi_schema['servers'] = [{'url': c['web']['baseurl']}]
-    openapi_json = json.dumps(openapi_schema, indent='  ', sort_keys=True)
+    json_schema = await request.app.hooks.mds_json_schema(
+        app=request.app,
+        method='PUT'
+    )
+    representations = _representations(
+        request.app['openapi'], json_schema, request.app.config['web']['baseurl']
+    )
+    encoding = _content_encoding(request, representations.bodies)
+    if encoding == 'identity':
+        etag = '"{}"'.format(representations.etag)
+    else:
+        etag = '"{}-{}"'.format(representations.etag, encoding)
+    headers = {'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if etag_if_none_match == conditional.REQ_ETAG_STAR or (
+            etag_if_none_match is not None and
+            conditional.match_etags(etag, etag_if_none_match, True)):
+        raise web.HTTPNotModified(headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
 
     return web.Response(
-        text=openapi_json,
-        content_type=request['best_content_type']
+        body=representations.bodies[encoding],
+        content_type=request['best_content_type'],
+        charset='utf-8',
+        headers=headers
     )
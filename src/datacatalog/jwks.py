@@ -1,16 +1,22 @@
 # language=rst
 """Helper module to handle JWKS stuff.
 
-This module provides only one method: :meth:`load`, which may raise a
-:exc:`JWKError`.
+This module provides :meth:`load`, which may raise a :exc:`JWKError`, and
+:class:`KeySource`, which keeps a :class:`MutableKeySet` up to date with a
+JWKSet in a file or at a URL.
 
 """
+import asyncio
 import base64
 import collections
 import json
+import logging
+import os
 import sys
+import typing as T
 from types import MappingProxyType
 
+import aiohttp
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.utils import int_from_bytes
@@ -24,11 +30,126 @@ _KeySet = collections.namedtuple('KeySet', 'signers verifiers')
 """Immutable type for key sets"""
 
 
+_logger = logging.getLogger(__name__)
+
+
 class JWKError(Exception):
     # language=rst
     """Error raised when parsing a JWKSet fails."""
 
 
+class MutableKeySet(object):
+    # language=rst
+    """A key set whose keys can be replaced while the application runs.
+
+    Like the key sets returned by :meth:`load`, it has ``signers`` and
+    ``verifiers``. :meth:`replace` swaps both at once, so readers always see
+    keys from the same JWKSet.
+
+    """
+
+    def __init__(self, keyset):
+        self._keyset = keyset
+
+    @property
+    def signers(self) -> T.Mapping[str, _Key]:
+        return self._keyset.signers
+
+    @property
+    def verifiers(self) -> T.Mapping[str, _Key]:
+        return self._keyset.verifiers
+
+    def replace(self, keyset):
+        self._keyset = keyset
+
+
+class KeySource(object):
+    # language=rst
+    """A JWKSet in a file or at a URL, loaded into a :class:`MutableKeySet`.
+
+    The JWKSet is only loaded again if it changed: for files, that's when their
+    modification time or size changed. URLs are requested with
+    ``If-None-Match`` and ``If-Modified-Since``.
+
+    """
+
+    def __init__(self, keyset: MutableKeySet, path: T.Optional[str]=None,
+                 url: T.Optional[str]=None):
+        assert (path is None) != (url is None)
+        self.keyset = keyset
+        self.path = path
+        self.url = url
+        self._validators: T.Dict[str, T.Any] = {}
+
+    async def refresh(self, session: T.Optional[aiohttp.ClientSession]=None) -> bool:
+        # language=rst
+        """Load the JWKSet if it changed.
+
+        :param session: the client session for requests to :attr:`url`.
+        :returns: whether the keys were replaced.
+        :raises JWKError: if the JWKSet can't be loaded or parsed.
+
+        """
+        if self.path is not None:
+            fetched = self._read_file()
+        else:
+            fetched = await self._fetch(session)
+        if fetched is None:
+            return False
+        jwks, validators = fetched
+        self.keyset.replace(load(jwks))
+        # Only now, so that a JWKSet that fails to load is loaded again on the
+        # next refresh, even if it didn't change:
+        self._validators = validators
+        _logger.info("Loaded JWKS from %s", self.path or self.url)
+        return True
+
+    def _read_file(self) -> T.Optional[T.Tuple[str, T.Dict[str, T.Any]]]:
+        try:
+            stat = os.stat(self.path)
+            validator = (stat.st_mtime_ns, stat.st_size)
+            if self._validators.get('stat') == validator:
+                return None
+            with open(self.path) as f:
+                jwks = f.read()
+        except OSError as e:
+            raise JWKError("Can't read {}".format(self.path)) from e
+        return jwks, {'stat': validator}
+
+    async def _fetch(self, session: aiohttp.ClientSession) \
+            -> T.Optional[T.Tuple[str, T.Dict[str, T.Any]]]:
+        headers = {}
+        if 'etag' in self._validators:
+            headers['If-None-Match'] = self._validators['etag']
+        if 'last_modified' in self._validators:
+            headers['If-Modified-Since'] = self._validators['last_modified']
+        try:
+            async with session.get(self.url, headers=headers) as response:
+                if response.status == 304:
+                    return None
+                if response.status != 200:
+                    raise JWKError("Got status {} from {}".format(response.status, self.url))
+                jwks = await response.text()
+                validators = {
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified')
+                }
+        except aiohttp.ClientError as e:
+            raise JWKError("Can't fetch {}".format(self.url)) from e
+        return jwks, {k: v for k, v in validators.items() if v is not None}
+
+    async def run(self, interval: float):
+        # language=rst
+        """Refresh the keys every ``interval`` seconds, until cancelled."""
+        async with aiohttp.ClientSession() as session:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await self.refresh(session)
+                except JWKError:
+                    _logger.exception("Refreshing the JWKS failed; keeping the current keys")
+
+
 def load(jwks):
     # language=rst
     """Parse a JWKSet and return a dictionary that maps key IDs on keys.
@@ -116,6 +116,34 @@ def storage_retrieve(app, docid: str, etags: T.Optional[T.Set[str]]) \
     """
 
 
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_retrieve_many(app, docids: T.List[str]) -> T.Dict[str, T.Tuple[dict, str]]:
+    # language=rst
+    """ Get many documents and their etags at once.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docids: document ids
+    :returns: a mapping of the ids of the documents that exist to ``(doc,
+        etag)`` tuples, like :func:`storage_retrieve` returns.
+
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_etag(app, docid: str) -> str:
+    # language=rst
+    """ Get the etag of a document, without the document itself.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docid: document id
+    :returns: the current etag.
+    :raises KeyError: if not found
+
+    """
+
+
 # noinspection PyUnusedLocal
 @hookspec.first_only.required
 def storage_create(app, docid: str, doc: dict, searchable_text: dict,
@@ -156,6 +184,40 @@ def storage_update(app, docid: str, doc: dict, searchable_text: dict,
     """
 
 
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_create_many(app, docs: T.List[T.Tuple[str, dict, dict, T.Optional[str]]]) \
+        -> T.List[T.Union[str, Exception]]:
+    # language=rst
+    """ Store many new documents at once.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(docid, doc, searchable_text, iso_639_1_code)``
+        tuples, with the same meaning as the arguments of
+        :func:`storage_create`.
+    :returns: for each document, in order, either its new ETag or a
+        :class:`KeyError` instance if the docid already exists.
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_update_many(app, docs: T.List[T.Tuple[str, dict, dict, T.Set[str], T.Optional[str]]]) \
+        -> T.List[T.Union[str, Exception]]:
+    # language=rst
+    """ Update many documents at once, each only if it has one of the provided Etags.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(docid, doc, searchable_text, etags,
+        iso_639_1_code)`` tuples, with the same meaning as the arguments of
+        :func:`storage_update`.
+    :returns: for each document, in order, either its new ETag, a
+        :class:`KeyError` instance if the docid doesn't exist, or a
+        :class:`ValueError` instance if none of its etags match the stored
+        etag.
+    """
+
+
 # noinspection PyUnusedLocal
 @hookspec.first_only.required
 def storage_delete(app, docid: str, etags: T.Set[str]) -> None:
@@ -202,6 +264,71 @@ async def storage_all(app: T.Mapping[str, T.Any]) -> T.AsyncGenerator[T.Tuple[st
     """
 
 
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_retrieve_rendition(app, docid: str, version: str) \
+        -> T.Tuple[T.Optional[dict], str]:
+    # language=rst
+    """ Get the rendition of a document and its etag.
+
+    See :mod:`datacatalog.rendering`.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docid: the document id
+    :param version: the current version of the rendering.
+    :returns: a tuple. The first element is the stored rendition, or None if
+        there is no rendition of the given version. The second element is the
+        current etag of the document.
+    :raises: KeyError if not found
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_store_rendition(app, docid: str, etag: str, version: str,
+                            rendition: dict, summary: dict) -> bool:
+    # language=rst
+    """ Store the rendition of a document, if the document still has the given etag.
+
+    Storing a new version of a document removes its rendition.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docid: the document id
+    :param etag: the etag of the document that was rendered.
+    :param version: the version of the rendering.
+    :param rendition: the rendered document.
+    :param summary: the list view projection of the rendered document.
+    :returns: whether the rendition was stored.
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def storage_store_rendition_many(app, version: str,
+                                 renditions: T.List[T.Tuple[str, str, dict, dict]]) -> T.List[bool]:
+    # language=rst
+    """ Store many renditions at once, like :func:`storage_store_rendition`.
+
+    :param app: the `~datacatalog.application.Application`
+    :param version: the version of the rendering.
+    :param renditions: a list of ``(docid, etag, rendition, summary)`` tuples.
+    :returns: for each rendition, in order, whether it was stored.
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+async def storage_stale_renditions(app, version: str) \
+        -> T.AsyncGenerator[T.Tuple[str, str, dict], None]:
+    # language=rst
+    """ Get all documents without a rendition of the given version.
+
+    :param app: the `~datacatalog.application.Application`
+    :param version: the current version of the rendering.
+    :returns: A generator over (id, etag, document) tuples.
+    """
+
+
 ################
 # Object Store #
 ################
@@ -234,6 +361,7 @@ def search_search(
     result_info: T.MutableMapping,
     facets: T.Optional[T.Iterable[str]]=None,
     limit: T.Optional[int]=None, offset: T.Optional[int]=0,
+    after: T.Optional[T.Tuple[str, str]]=None,
     filters: T.Optional[T.Mapping[
         str,  # a JSON pointer
         T.Mapping[
@@ -242,25 +370,46 @@ def search_search(
             T.Union[str, T.Set[str]]
         ]
     ]]=None,
-    iso_639_1_code: T.Optional[str]=None
-) -> T.AsyncGenerator[T.Tuple[str, dict], None]:
+    iso_639_1_code: T.Optional[str]=None,
+    summary: bool=False,
+    render_version: T.Optional[str]=None,
+    fields: T.Optional[T.List[str]]=None,
+    sort_key: bool=False
+) -> T.AsyncGenerator[T.Tuple, None]:
     # language=rst
     """ Search.
 
     :param app: the `~datacatalog.application.Application`
     :param q: the query
-    :param sortproperty: the property to sort by. Must be a top-level object property.
+    :param sortpath: the path of the property to sort by, in descending
+        order. Documents without a value sort last, as if their value were
+        the empty string.
     :param result_info: mapping in which all encountered facets in the result set are
         put
     :param facets: a list of facets to return and count
     :param limit: maximum hits to be returned
     :param offset: offset in resultset
+    :param after: for keyset pagination of listings: the sort value and id of
+        the last document on the previous page. Only documents that sort
+        after this document are returned.
     :param filters: mapping of JSON pointer -> value, used to filter on some
         value.
     :param iso_639_1_code: the language of the query
+    :param summary: if true, the renditions are reduced to the properties
+        that are shown in list views.
+    :param render_version: if given, the search results are (id, doc,
+        rendition) tuples. If the document has a rendition of this version
+        (see :func:`storage_retrieve_rendition`; the list view projection if
+        ``summary`` is true), doc is None. Otherwise the rendition is None.
+    :param fields: if given together with ``render_version``, the renditions
+        only contain these top-level properties.
+    :param sort_key: if true, the sort value of each document, as it is used
+        for ``after``, is appended to the search result tuples. It's ``None``
+        for full-text searches.
     :returns: A generator over the search results (id, doc, metadata)
     :raises: ValueError if filter syntax is invalid, if the ISO 639-1 code is
-        not recognized, or if the offset is invalid.
+        not recognized, if the offset is invalid, or if ``after`` is given
+        together with a query.
 
     """
 
@@ -284,13 +433,32 @@ def search_search(
 
 # noinspection PyUnusedLocal
 @hookspec.first_only
-def mds_canonicalize(app, data: dict) -> dict:
+def mds_canonicalize(app, data: dict, fields: T.Optional[dict]=None) -> dict:
     # language=rst
     """Canonicalize the given document according to this schema.
 
     :param app: the `~datacatalog.application.Application`
     :param data: the dataset
+    :param fields: an optional projection (see
+        :data:`datacatalog.dcat.Projection`); if given, only the selected
+        properties need to be canonicalized and returned.
     :returns: dict with canonicalized entries
+    :raises ValueError: or :exc:`TypeError`, if the dataset is invalid.
+
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def mds_canonicalize_many(app, docs: T.List[T.Tuple[str, dict]],
+                          fields: T.Optional[dict]=None) -> T.List[dict]:
+    # language=rst
+    """Canonicalize many documents at once, like :func:`mds_canonicalize`.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(docid, dataset)`` tuples
+    :param fields: an optional projection, as in :func:`mds_canonicalize`
+    :returns: for each document, in order, the canonicalized document
 
     """
 
@@ -325,11 +493,39 @@ def mds_after_storage(app, data: dict, doc_id: str) -> dict:
     """
 
 
+# noinspection PyUnusedLocal
+@hookspec.first_only
+def mds_after_storage_many(app, docs: T.List[T.Tuple[str, dict]]) -> T.List[dict]:
+    # language=rst
+    """Process many documents at once, like :func:`mds_after_storage`.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(doc_id, dataset)`` tuples
+    :returns: for each document, in order, the modified data dictionary
+
+    """
+
+
+# noinspection PyUnusedLocal
+@hookspec.sync
+def mds_after_write(app, docids: T.List[str]) -> None:
+    # language=rst
+    """Called after documents have been created, updated or deleted.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docids: the ids of the documents that were written
+
+    """
+
+
 # noinspection PyUnusedLocal
 @hookspec.first_only
 def mds_json_schema(app, method: str) -> dict:
     # language=rst
     """The json schema.
+
+    The result may be cached and shared between callers; it must not be
+    modified.
     """
 
 
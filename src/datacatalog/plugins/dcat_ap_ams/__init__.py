@@ -1,7 +1,9 @@
 from aiohttp import web
+import collections
 from copy import deepcopy
 import datetime
 import logging
+import time
 import typing as T
 
 from aiopluggy import HookimplMarker
@@ -16,6 +18,24 @@ _hookimpl = HookimplMarker('datacatalog')
 _BASE_URL = 'http://localhost/'
 _logger = logging.getLogger(__name__)
 
+_CompactionTerms = collections.namedtuple(
+    '_CompactionTerms', 'context prefixes id_terms literal_terms set_terms list_terms'
+)
+_compaction_terms_cache: T.Optional[_CompactionTerms] = None
+_context_cache: T.Optional[T.Tuple[str, dict]] = None
+
+_JSON_SCHEMA_TTL = 300.0
+# language=rst
+"""Seconds that the example values in :func:`mds_json_schema` may be stale.
+
+Writes through this process invalidate the examples immediately, but writes
+by other processes don't.
+
+"""
+# Maps methods to (the schema of DATASET, expiry time, schema with examples):
+_json_schema_cache: T.Dict[str, T.Tuple[dict, float, dict]] = {}
+_json_schema_generation = 0
+
 
 def _datasets_url(app) -> str:
     if isinstance(app, web.Application):
@@ -112,11 +132,15 @@ def _datasets_vary(a: dict, b: dict) -> bool:
 
 @_hookimpl
 def mds_before_storage(app, data, old_data=None) -> dict:
-    retval = deepcopy(data)
+    # Copy on write: only the top level object and the distributions are
+    # modified, other values are shared with ``data`` and ``old_data``.
+    retval = dict(data)
     retval.pop('dct:identifier', None)
 
     distributions = retval.get('dcat:distribution', [])
-    retval['dcat:distribution'] = distributions = _add_dc_identifiers_to(distributions)
+    retval['dcat:distribution'] = distributions = [
+        dict(distribution) for distribution in _add_dc_identifiers_to(distributions)
+    ]
 
     # Set all the meta-metadata timestamps correctly:
     if old_data is not None:
@@ -160,6 +184,7 @@ def mds_before_storage(app, data, old_data=None) -> dict:
                 # dct:modified and dcat:accessURL are not checked for changes in
                 # 'foaf:isPrimaryTopicOf'->'dct:modified'
                 if _distributions_vary(distribution, old_distribution, {'dct:modified', 'dcat:accessURL'}):
+                    distribution['foaf:isPrimaryTopicOf'] = dict(old_foaf)
                     distribution['foaf:isPrimaryTopicOf']['dct:modified'] = datetime.date.today().isoformat()
                 # dct:modified is set if accessURL is changed AND the date was not changed manually
                 # by the frontend. Currently disabled
@@ -192,7 +217,23 @@ def mds_before_storage(app, data, old_data=None) -> dict:
 
 @_hookimpl
 def mds_after_storage(app, data, doc_id):
-    retval = deepcopy(data)
+    return _after_storage(data, doc_id, _datasets_url(app))
+
+
+@_hookimpl
+def mds_after_storage_many(app, docs: T.List[T.Tuple[str, dict]]) -> T.List[dict]:
+    datasets_url = _datasets_url(app)
+    return [_after_storage(data, doc_id, datasets_url) for doc_id, data in docs]
+
+
+def _after_storage(data: dict, doc_id: str, datasets_url: str) -> dict:
+    # Copy on write: only the top level object and the distributions are
+    # modified, other values are shared with ``data``.
+    retval = dict(data)
+    if 'dcat:distribution' in retval:
+        retval['dcat:distribution'] = [
+            dict(distribution) for distribution in retval['dcat:distribution']
+        ]
     # The following is a temporary measure, for as long as not all the data
     # in the database has been converted.
     # TODO: Remove
@@ -218,7 +259,6 @@ def mds_after_storage(app, data, doc_id):
 
     distributions = retval.get('dcat:distribution', [])
     counter = 0
-    datasets_url = _datasets_url(app)
     for distribution in distributions:
         counter += 1
         distribution['@id'] = "_:d{}".format(counter)
@@ -238,32 +278,53 @@ def _add_dc_identifiers_to(distributions: T.List[dict]) -> T.List[dict]:
     )
     if len(all_persistent_ids) == len(distributions):
         return distributions
-    retval = deepcopy(distributions)
+    retval = []
     persistent_id = 1
-    for distribution in retval:
+    for distribution in distributions:
         # persistent id:
         if 'dc:identifier' not in distribution:
             while str(persistent_id) in all_persistent_ids:
                 persistent_id += 1
             all_persistent_ids.add(str(persistent_id))
+            # Copy only the distributions that change:
+            distribution = dict(distribution)
             distribution['dc:identifier'] = str(persistent_id)
+        retval.append(distribution)
     return retval
 
 
 @_hookimpl
-def mds_canonicalize(app, data: dict) -> dict:
+def mds_canonicalize(app, data: dict, fields: T.Optional[dict]=None) -> dict:
     # language=rst
     """
     TODO: Documentation of this vital function.
     """
+    return _canonicalize(data, mds_context(), fields)
+
+
+@_hookimpl
+def mds_canonicalize_many(app, docs: T.List[T.Tuple[str, dict]],
+                          fields: T.Optional[dict]=None) -> T.List[dict]:
     ctx = mds_context()
+    return [_canonicalize(data, ctx, fields) for docid, data in docs]
+
+
+def _canonicalize(data: dict, ctx: dict, fields: T.Optional[dict]) -> dict:
     # if '@context' not in data:
     #     _logger.warning("No @context in data to be canonicalized.")
     #     data['@context'] = ctx
     # The expansion is implicitly done in jsonld.compact() below.
     # data = jsonld.expand(data)
-    retval = jsonld.compact(data, ctx)
-    retval = DATASET.canonicalize(retval)
+    if _is_compact(data, ctx):
+        # Documents from our own store are already compacted under the same
+        # context, in which case compaction wouldn't change anything.
+        retval = data
+    else:
+        try:
+            retval = jsonld.compact(data, ctx)
+        except jsonld.JsonLdError as e:
+            raise ValueError('Invalid JSON-LD') from e
+    retval = DATASET.canonicalize(retval, fields)
     if 'dcat:distribution' not in retval:
         retval['dcat:distribution'] = []
     retval['@context'] = ctx
@@ -280,11 +341,127 @@ def mds_canonicalize(app, data: dict) -> dict:
     return retval
 
 
+def _compaction_terms(ctx: dict) -> _CompactionTerms:
+    global _compaction_terms_cache
+    if _compaction_terms_cache is None or _compaction_terms_cache.context != ctx:
+        prefixes = {}
+
+        def expand(iri: str) -> str:
+            prefix, sep, suffix = iri.partition(':')
+            if sep and prefix in ctx and isinstance(ctx[prefix], str) and not suffix.startswith('//'):
+                return expand(ctx[prefix]) + suffix
+            return iri
+
+        for term, definition in ctx.items():
+            if isinstance(definition, str) and ':' not in term:
+                prefixes[term] = expand(definition)
+        definitions = {
+            term: definition for term, definition in ctx.items()
+            if isinstance(definition, dict)
+        }
+        _compaction_terms_cache = _CompactionTerms(
+            context=ctx,
+            prefixes=prefixes,
+            id_terms={t for t, d in definitions.items() if d.get('@type') == '@id'},
+            literal_terms={t for t, d in definitions.items() if d.get('@type', '@id') != '@id'},
+            set_terms={t for t, d in definitions.items() if d.get('@container') == '@set'},
+            list_terms={t for t, d in definitions.items() if d.get('@container') == '@list'}
+        )
+    return _compaction_terms_cache
+
+
+def _is_compact_iri(iri: str, terms: _CompactionTerms) -> bool:
+    # language=rst
+    """Whether ``iri`` is in the form JSON-LD compaction would give it.
+
+    That is the shortest (and then lexicographically least) compact IRI using
+    one of the prefixes of the context, or the absolute IRI if none applies.
+
+    """
+    prefix, sep, suffix = iri.partition(':')
+    if not sep:
+        # A relative IRI
+        return False
+    if prefix in terms.prefixes and not suffix.startswith('//'):
+        iri = terms.prefixes[prefix] + suffix
+    candidates = [
+        term + ':' + iri[len(prefix_iri):]
+        for term, prefix_iri in terms.prefixes.items()
+        if iri.startswith(prefix_iri) and len(iri) > len(prefix_iri)
+    ]
+    if len(candidates) == 0:
+        return prefix not in terms.prefixes
+    return min(candidates, key=lambda c: (len(c), c)) == prefix + ':' + suffix
+
+
+def _is_compact_node(node: dict, terms: _CompactionTerms) -> bool:
+    if len(node) == 0:
+        return False
+    for key, value in node.items():
+        if key == '@id':
+            if not isinstance(value, str) or not _is_compact_iri(value, terms):
+                return False
+            continue
+        if key.startswith('@') or key in terms.list_terms or \
+                not _is_compact_iri(key, terms):
+            return False
+        # Compaction always turns the value of a @set into a list, and a
+        # list with one element anywhere else into that element:
+        if isinstance(value, list) != (key in terms.set_terms):
+            return False
+        for v in (value if isinstance(value, list) else [value]):
+            if v is None or isinstance(v, list):
+                return False
+            if key in terms.id_terms:
+                if not isinstance(v, str) or not _is_compact_iri(v, terms):
+                    return False
+            elif key in terms.literal_terms:
+                if not isinstance(v, str):
+                    return False
+            elif isinstance(v, dict) and not _is_compact_node(v, terms):
+                return False
+    return True
+
+
+def _is_compact(data: dict, ctx: dict) -> bool:
+    # language=rst
+    """Whether ``data`` is already compacted under ``ctx``.
+
+    This is a conservative check: when it returns ``True``, compaction of
+    ``data`` would return ``data`` itself. Documents that use other
+    keywords than ``@id``, aliases, full IRIs, or values that JSON-LD
+    would rewrite must go through :func:`jsonld.compact`.
+
+    """
+    if data.get('@context') != ctx:
+        return False
+    terms = _compaction_terms(ctx)
+    return _is_compact_node(
+        {key: value for key, value in data.items() if key != '@context'}, terms
+    )
+
+
+@_hookimpl
+def mds_after_write(app, docids: T.List[str]):
+    global _json_schema_generation
+    # The datasets may have added or removed owners or keywords:
+    _json_schema_generation += 1
+    _json_schema_cache.clear()
+
+
 @_hookimpl
 async def mds_json_schema(app, method: str) -> dict:
-    result = DATASET.schema(method)
+    schema = DATASET.schema(method)
     if method == 'GET':
-        return result
+        return schema
+    cached = _json_schema_cache.get(method)
+    if cached is not None and cached[0] is schema and time.monotonic() < cached[1]:
+        return cached[2]
+    generation = _json_schema_generation
+    expires = time.monotonic() + _JSON_SCHEMA_TTL
+
+    # The schema of DATASET is shared, so add the examples to a copy:
+    result = deepcopy(schema)
     owners = await app.hooks.storage_extract(
         app=app, ptr='/properties/ams:owner', distinct=True)
     owners = sorted([owner async for owner in owners])
@@ -294,6 +471,10 @@ async def mds_json_schema(app, method: str) -> dict:
         app=app, ptr='/properties/dcat:keyword/items', distinct=True)
     keywords = sorted([keyword async for keyword in keywords])
     result['properties']['dcat:keyword']['items']['examples'] = keywords
+
+    # Don't cache examples that a concurrent write may have made stale:
+    if generation == _json_schema_generation:
+        _json_schema_cache[method] = (schema, expires, result)
     return result
 
 
@@ -312,9 +493,19 @@ def mds_full_text_search_representation(data: dict) -> dict:
 
 @_hookimpl
 def mds_context() -> dict:
-    retval = dict(CONTEXT)
-    retval['ams-dcatd'] = _BASE_URL + 'datasets/'
-    return retval
+    # language=rst
+    """The JSON-LD context.
+
+    The context is built once per base URL. The result is shared, so it must
+    not be modified.
+
+    """
+    global _context_cache
+    if _context_cache is None or _context_cache[0] != _BASE_URL:
+        retval = dict(CONTEXT)
+        retval['ams-dcatd'] = _BASE_URL + 'datasets/'
+        _context_cache = (_BASE_URL, retval)
+    return _context_cache[1]
 
 
 # print(json.dumps(
@@ -3,6 +3,7 @@
 import asyncio
 import base64
 import collections
+import functools
 import hashlib
 import json
 import logging
@@ -21,6 +22,11 @@ from aiohttp_extras import conditional
 
 from .languages import ISO_639_1_TO_PG_DICTIONARIES
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 _hookimpl = aiopluggy.HookimplMarker('datacatalog')
 _logger = logging.getLogger(__name__)
 
@@ -30,6 +36,21 @@ _DEFAULT_CONNECTION_TIMEOUT = 60
 _DEFAULT_MIN_POOL_SIZE = 0
 _DEFAULT_MAX_POOL_SIZE = 5
 _DEFAULT_MAX_INACTIVE_CONNECTION_LIFETIME = 5.0
+_DEFAULT_STATEMENT_CACHE_SIZE = 256
+_DEFAULT_JSON_CODEC = 'orjson' if orjson is not None else 'json'
+_DEFAULT_JSONB_FORMAT = 'text'
+# Generated columns need PostgreSQL 12; jsonb_path_query needs 12 too.
+_MIN_SERVER_VERSION = 12
+_DEFAULT_MATERIALIZED_FACETS = [
+    '/properties/dcat:distribution/items/properties/ams:resourceType',
+    '/properties/dcat:distribution/items/properties/dcat:mediaType',
+    '/properties/dcat:distribution/items/properties/ams:distributionType',
+    '/properties/dcat:distribution/items/properties/ams:serviceType',
+    '/properties/dcat:keyword/items',
+    '/properties/dcat:theme/items',
+    '/properties/ams:owner',
+    '/properties/ams:status'
+]
 
 _Q_CREATE = '''
 CREATE TABLE IF NOT EXISTS "dataset" (
@@ -37,37 +58,185 @@ CREATE TABLE IF NOT EXISTS "dataset" (
     "doc" jsonb NOT NULL,
     "etag" character varying(254) NOT NULL,
     "searchable_text" tsvector,
-    "lang" character varying(20)
+    "lang" character varying(20),
+    "sort_modified" text GENERATED ALWAYS AS (coalesce(doc->>'ams:sort_modified', '')) STORED,
+    "status" text GENERATED ALWAYS AS (doc->>'ams:status') STORED,
+    "owner" text GENERATED ALWAYS AS (doc->>'ams:owner') STORED,
+    "rendered" jsonb,
+    "rendered_summary" jsonb,
+    "render_version" text,
+    "rendered_etag" character varying(254)
 );
 CREATE INDEX IF NOT EXISTS "idx_id_etag" ON "dataset" ("id", "etag");
 CREATE INDEX IF NOT EXISTS "idx_full_text_search" ON "dataset" USING gin ("searchable_text");
 CREATE INDEX IF NOT EXISTS "idx_json_docs" ON "dataset" USING gin ("doc" jsonb_path_ops);
+CREATE TABLE IF NOT EXISTS "dataset_facets" (
+    "facet_ptr" text NOT NULL,
+    "value" text NOT NULL,
+    "status" text NOT NULL,
+    "lang" character varying(20) NOT NULL,
+    "count" integer NOT NULL,
+    PRIMARY KEY ("facet_ptr", "value", "status", "lang")
+);
+'''
+
+# Brings tables created by older versions up to date. Must be idempotent.
+_Q_MIGRATE = '''
+ALTER TABLE "dataset"
+    ADD COLUMN IF NOT EXISTS "sort_modified" text
+        GENERATED ALWAYS AS (coalesce(doc->>'ams:sort_modified', '')) STORED,
+    ADD COLUMN IF NOT EXISTS "status" text GENERATED ALWAYS AS (doc->>'ams:status') STORED,
+    ADD COLUMN IF NOT EXISTS "owner" text GENERATED ALWAYS AS (doc->>'ams:owner') STORED,
+    ADD COLUMN IF NOT EXISTS "rendered" jsonb,
+    ADD COLUMN IF NOT EXISTS "rendered_summary" jsonb,
+    ADD COLUMN IF NOT EXISTS "render_version" text,
+    ADD COLUMN IF NOT EXISTS "rendered_etag" character varying(254),
+    -- Superseded by rendered_summary:
+    DROP COLUMN IF EXISTS "summary";
+DROP INDEX IF EXISTS "idx_sort_modified_id";
+CREATE INDEX IF NOT EXISTS "idx_sort_modified" ON "dataset" ("sort_modified" DESC, "id" DESC);
+CREATE INDEX IF NOT EXISTS "idx_status" ON "dataset" ("status");
+CREATE INDEX IF NOT EXISTS "idx_owner" ON "dataset" ("owner");
 '''
 
 SEARCH_VECTOR = "SETWEIGHT(TO_TSVECTOR('simple', ${:d}), 'A') || SETWEIGHT(TO_TSVECTOR('simple', ${:d}), 'B') || \
 SETWEIGHT(TO_TSVECTOR('simple', ${:d}), 'C') || SETWEIGHT(TO_TSVECTOR('simple', ${:d}), 'D')"
 _Q_HEALTHCHECK = 'SELECT 1'
 _Q_RETRIEVE_DOC = 'SELECT doc, etag FROM "dataset" WHERE id = $1'
+_Q_RETRIEVE_ETAG = 'SELECT etag FROM "dataset" WHERE id = $1'
+_Q_RETRIEVE_MANY_DOCS = 'SELECT id, doc, etag FROM "dataset" WHERE id = ANY($1::varchar[])'
+_Q_CLEAR_RENDITION = 'rendered=NULL, rendered_summary=NULL, render_version=NULL, rendered_etag=NULL'
+# A rendition is current if it has the current rendering version, and was
+# rendered from the stored version of the document:
+_Q_RENDITION_IS_CURRENT = 'render_version={version} AND rendered_etag=etag'
 _Q_INSERT_DOC = 'INSERT INTO "dataset" (id, doc, searchable_text, lang, etag) VALUES ($1, $2, ' + \
                    SEARCH_VECTOR.format(3, 4, 5, 6) + ', $7, $8)'
 _Q_UPDATE_DOC = 'UPDATE "dataset" SET doc=$1, searchable_text=' + \
-                   SEARCH_VECTOR.format(2, 3, 4, 5) + ', etag=$6 WHERE id=$7 AND etag=ANY($8) RETURNING id'
+                   SEARCH_VECTOR.format(2, 3, 4, 5) + ', etag=$6, ' + \
+                   _Q_CLEAR_RENDITION + ' WHERE id=$7 AND etag=ANY($8) RETURNING id'
+_Q_RETRIEVE_RENDITION = 'SELECT CASE WHEN ' + _Q_RENDITION_IS_CURRENT.format(version='$2') + \
+                        ' THEN rendered END AS rendered, etag FROM "dataset" WHERE id=$1'
+_Q_STORE_RENDITION = 'UPDATE "dataset" SET rendered=$3, rendered_summary=$4, render_version=$5, rendered_etag=$2 ' \
+                     'WHERE id=$1 AND etag=$2 RETURNING id'
+_Q_STORE_MANY_RENDITIONS = '''
+UPDATE "dataset" SET rendered=r.rendered::jsonb, rendered_summary=r.summary::jsonb, render_version=$5,
+    rendered_etag=r.etag
+FROM unnest($1::varchar[], $2::varchar[], $3::text[], $4::text[]) AS r(id, etag, rendered, summary)
+WHERE "dataset".id = r.id AND "dataset".etag = r.etag
+RETURNING "dataset".id
+'''
+_Q_STALE_RENDITIONS = 'SELECT id, etag, doc FROM "dataset" ' \
+                      'WHERE render_version IS DISTINCT FROM $1 OR rendered_etag IS DISTINCT FROM etag'
 
 _Q_DELETE_DOC = 'DELETE FROM "dataset" WHERE id=$1 AND etag=ANY($2) RETURNING id'
+_Q_LOCK_DOC = 'SELECT etag FROM "dataset" WHERE id=$1 FOR UPDATE'
+# Bulk variants of the above; all rows are passed as parallel arrays.
+_Q_INSERT_MANY_DOCS = '''
+INSERT INTO "dataset" (id, doc, searchable_text, lang, etag)
+SELECT r.id, r.doc::jsonb, ''' + SEARCH_VECTOR.replace('${:d}', 'r.{}').format('a', 'b', 'c', 'd') + ''', r.lang, r.etag
+FROM unnest($1::varchar[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::varchar[], $8::varchar[])
+     AS r(id, doc, a, b, c, d, lang, etag)
+ON CONFLICT (id) DO NOTHING
+RETURNING id
+'''
+_Q_UPDATE_MANY_DOCS = '''
+UPDATE "dataset" SET doc=r.doc::jsonb, searchable_text=''' + SEARCH_VECTOR.replace('${:d}', 'r.{}').format('a', 'b', 'c', 'd') + ''', etag=r.etag,
+    ''' + _Q_CLEAR_RENDITION + '''
+FROM unnest($1::varchar[], $2::text[], $3::text[], $4::text[], $5::text[], $6::text[], $7::varchar[])
+     AS r(id, doc, a, b, c, d, etag)
+WHERE "dataset".id = r.id
+'''
+_Q_LOCK_MANY_DOCS = 'SELECT id, etag FROM "dataset" WHERE id = ANY($1::varchar[]) ORDER BY id FOR UPDATE'
+
+# Adds $3 (either 1 or -1) times the facet values of the selected documents to
+# the facet count table. The pseudo-facet ``/`` counts the documents
+# themselves. Rows are upserted (and so locked) in a fixed order, so that
+# concurrent writes can't deadlock on them.
+_Q_ADD_FACETS = """
+INSERT INTO "dataset_facets" AS f (facet_ptr, value, status, lang, count)
+SELECT facet.ptr,
+       CASE WHEN facet.ptr = '/' THEN '' ELSE coalesce(facet_value #>> '{{}}', '') END,
+       coalesce(doc->>'ams:status', ''),
+       coalesce(lang, ''),
+       $3 * count(*)
+FROM "dataset",
+     unnest($1::text[], $2::text[]) AS facet(ptr, path),
+     jsonb_path_query(doc, facet.path::jsonpath, '{{}}', true) AS facet_value
+WHERE {docs}
+GROUP BY 1, 2, 3, 4
+ORDER BY 1, 2, 3, 4
+ON CONFLICT (facet_ptr, value, status, lang) DO UPDATE SET count = f.count + EXCLUDED.count
+"""
+_Q_UPDATE_DOC_FACETS = _Q_ADD_FACETS.format(docs='id = ANY($4::varchar[])')
+_Q_CLEAN_FACETS = 'DELETE FROM "dataset_facets" WHERE count <= 0'
+_Q_TRUNCATE_FACETS = 'TRUNCATE "dataset_facets"'
+_Q_REBUILD_FACETS = _Q_ADD_FACETS.format(docs='TRUE')
+_Q_MATERIALIZED_FACET_COUNTS = """
+SELECT facet_ptr AS facet, value, sum(count) AS count
+FROM "dataset_facets"
+WHERE facet_ptr = ANY($1::text[])
+  AND ($2::text[] IS NULL OR status = ANY($2::text[]))
+  AND ('simple'=$3::varchar OR lang=$3::varchar)
+GROUP BY facet_ptr, value
+"""
 _Q_RETRIEVE_ALL_DOCS = 'SELECT doc FROM "dataset"'
+_Q_DISTINCT_FACET_VALUES = 'SELECT DISTINCT value FROM "dataset_facets" WHERE facet_ptr=$1 AND count > 0 ORDER BY value'
+_Q_STORED_FACETS = 'SELECT DISTINCT facet_ptr FROM "dataset_facets"'
+# The query templates below are filled in with bind parameter placeholders (see
+# :func:`_bind`), so that the statement text only depends on the structure of
+# a query and its prepared statement can be reused.
 _Q_SEARCH_DOCS = """
-SELECT id, doc, 2 * ts_rank_cd(searchable_text, fullmatch_query) + ts_rank_cd(searchable_text, prefix_query) AS rank
-FROM "dataset", to_tsquery('simple', $1) prefix_query, to_tsquery('simple', $2) fullmatch_query
-WHERE (''=$1::varchar OR searchable_text @@ prefix_query) {filters}
-ORDER BY rank DESC;
+SELECT id, {columns}, 2 * ts_rank_cd(searchable_text, to_tsquery('simple', {fullmatch})) + ts_rank_cd(searchable_text, to_tsquery('simple', {prefix})) AS rank
+FROM "dataset"
+WHERE {where}
+ORDER BY rank DESC
+LIMIT {limit} OFFSET {offset};
 """
+_Q_SEARCH_WHERE = "(''={prefix}::varchar OR searchable_text @@ to_tsquery('simple', {prefix})) {filters}"
 
 
 _Q_LIST_DOCS = """
-SELECT id, doc
+SELECT id, {columns}
 FROM "dataset"
-WHERE ('simple'=$1::varchar OR lang=$1::varchar) {filters}
-ORDER BY {sortexpression} DESC;
+WHERE {where} {seek}
+ORDER BY {sortexpression} DESC, id DESC
+LIMIT {limit} OFFSET {offset};
+"""
+_Q_LIST_WHERE = "('simple'={lang}::varchar OR lang={lang}::varchar) {filters}"
+# Documents without a sort value sort last (before the coalesce, NULLs sorted
+# first in descending order), and are still reachable by keyset pagination:
+_Q_SORT_EXPRESSION = "coalesce(doc #>> {path}::text[], '')"
+# Generated columns that can replace JSON expressions:
+_SORT_COLUMNS = {
+    ('ams:sort_modified',): 'sort_modified'
+}
+_FILTER_COLUMNS = {
+    '/properties/ams:status': 'status',
+    '/properties/ams:owner': 'owner'
+}
+# Selects either the document or its current rendition:
+_Q_RENDITION_COLUMNS = """CASE WHEN {current} THEN NULL ELSE doc END AS doc, \
+CASE WHEN {current} THEN {rendered} END AS rendered"""
+# Only the given top-level properties of a jsonb document:
+_Q_PROJECTION = """(SELECT coalesce(jsonb_object_agg(key, value), '{{}}'::jsonb) \
+FROM jsonb_each({doc}) WHERE key = ANY({keys}::text[]))"""
+_Q_LIST_SEEK = 'AND ({sortexpression}, id) < ({sort_value}::text, {id}::varchar)'
+
+_Q_COUNT_DOCS = 'SELECT count(*) FROM "dataset" WHERE {where}'
+# Counts the matching documents (as facet ``/``) and all facet values in a
+# single aggregate. Facets are given as two parallel arrays of JSON pointers
+# and their equivalent SQL/JSON paths; see _to_pg_jsonpath.
+_Q_FACET_COUNTS = """
+WITH matches AS (
+    SELECT doc FROM "dataset" WHERE {where}
+)
+SELECT '/' AS facet, NULL AS value, count(*) AS count FROM matches
+UNION ALL
+SELECT facet.ptr, facet_value #>> '{{}}', count(*)
+FROM matches,
+     unnest({ptrs}::text[], {paths}::text[]) AS facet(ptr, path),
+     jsonb_path_query(matches.doc, facet.path::jsonpath, '{{}}', true) AS facet_value
+GROUP BY facet.ptr, facet_value #>> '{{}}'
 """
 
 _Q_CREATE_STARTUP_ACTIONS = '''
@@ -77,6 +246,17 @@ CREATE TABLE IF NOT EXISTS "dcatd_startup_actions" (
     applied TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
 );
 '''
+# The facet count table is only refilled at startup if it was filled with
+# other facets or paths; these are recorded as a startup action:
+_FACETS_ACTION_PREFIX = 'materialized_facets:'
+_Q_LOCK_STARTUP_ACTIONS = 'LOCK TABLE "dcatd_startup_actions" IN EXCLUSIVE MODE'
+_Q_FACETS_FILLED = '''
+SELECT EXISTS (SELECT 1 FROM "dcatd_startup_actions" WHERE action = $1)
+   AND EXISTS (SELECT 1 FROM "dataset_facets")
+'''
+_Q_FORGET_FACETS_FILLED = 'DELETE FROM "dcatd_startup_actions" WHERE action LIKE \'' + \
+                          _FACETS_ACTION_PREFIX + '%\''
+_Q_ADD_STARTUP_ACTION = 'INSERT INTO "dcatd_startup_actions" (action) VALUES ($1)'
 
 
 @_hookimpl
@@ -106,6 +286,19 @@ async def initialize(app):
     max_pool_size = dbconf.get('max_pool_size', _DEFAULT_MAX_POOL_SIZE)
     max_inactive_conn_lifetime = dbconf.get(
         'max_inactive_connection_lifetime', _DEFAULT_MAX_INACTIVE_CONNECTION_LIFETIME)
+    statement_cache_size = dbconf.get('statement_cache_size', _DEFAULT_STATEMENT_CACHE_SIZE)
+    jsonb_codec = _jsonb_codec(
+        dbconf.get('json_codec', _DEFAULT_JSON_CODEC),
+        dbconf.get('jsonb_format', _DEFAULT_JSONB_FORMAT)
+    )
+    materialized_facets = dbconf.get('materialized_facets', _DEFAULT_MATERIALIZED_FACETS)
+    try:
+        app['materialized_facets'] = [('/', 'strict $')] + [
+            (f, _to_pg_jsonpath(jsonpointer.JsonPointer(f).parts))
+            for f in materialized_facets
+        ]
+    except jsonpointer.JsonPointerException:
+        raise ValueError('Cannot parse pointer')
 
     # create asyncpg engine
     _logger.info("Connecting to database: postgres://%s:%i/%s",
@@ -124,6 +317,8 @@ async def initialize(app):
                 min_size=min_pool_size,
                 max_size=max_pool_size,
                 max_inactive_connection_lifetime=max_inactive_conn_lifetime,
+                statement_cache_size=statement_cache_size,
+                init=functools.partial(_init_connection, jsonb_codec=jsonb_codec),
                 loop=app.loop
             )
         except ConnectionRefusedError:
@@ -138,8 +333,11 @@ async def initialize(app):
             break
     while connect_attempt_tries_left >= 0:
         try:
+            await _check_server_version(app)
             await app['pool'].execute(_Q_CREATE)
+            await app['pool'].execute(_Q_MIGRATE)
             await app['pool'].execute(_Q_CREATE_STARTUP_ACTIONS)
+            await _rebuild_facets(app)
         except ConnectionRefusedError:
             if connect_attempt_tries_left > 0:
                 _logger.warning("Database not accepting connections. Retrying %d more times.", connect_attempt_tries_left)
@@ -153,6 +351,130 @@ async def initialize(app):
     _logger.info("Successfully connected to postgres.")
 
 
+async def _check_server_version(app):
+    async with app['pool'].acquire() as con:
+        version = con.get_server_version()
+    if version.major < _MIN_SERVER_VERSION:
+        raise ValueError(
+            'PostgreSQL {} or above is required; the server runs {}.{}'.format(
+                _MIN_SERVER_VERSION, version.major, version.minor)
+        )
+
+
+def _jsonb_codec(library: str, format: str) -> T.Dict[str, T.Any]:
+    # language=rst
+    """Build the keyword arguments for :meth:`asyncpg.Connection.set_type_codec`
+    of the ``jsonb`` type.
+
+    :param library: either ``json`` or ``orjson``.
+    :param format: either ``text`` or ``binary``. The binary wire format of
+        jsonb is the text representation prefixed with a version byte.
+    :raises ValueError: if the requested library is not available.
+
+    Values that are already serialized (:class:`str` or :class:`bytes`) are
+    sent as is; stored documents are serialized by the plugin itself because
+    their Etag is computed from the serialization.
+
+    """
+    if library == 'orjson':
+        if orjson is None:
+            raise ValueError('JSON codec orjson is not installed')
+        loads, dumps = orjson.loads, orjson.dumps
+    else:
+        loads = json.loads
+
+        def dumps(value):
+            return json.dumps(value, ensure_ascii=False).encode()
+
+    if format == 'binary':
+        def encoder(value) -> bytes:
+            if isinstance(value, str):
+                value = value.encode()
+            elif not isinstance(value, bytes):
+                value = dumps(value)
+            return b'\x01' + value
+
+        def decoder(data: bytes):
+            if data[:1] != b'\x01':
+                raise ValueError('Unsupported jsonb format version')
+            return loads(data[1:])
+    else:
+        def encoder(value) -> str:
+            if isinstance(value, bytes):
+                return value.decode()
+            if isinstance(value, str):
+                return value
+            return dumps(value).decode()
+
+        decoder = loads
+    return {'encoder': encoder, 'decoder': decoder, 'format': format}
+
+
+async def _init_connection(con, jsonb_codec: T.Dict[str, T.Any]):
+    # Documents arrive decoded, so the read paths don't have to parse them.
+    await con.set_type_codec('jsonb', schema='pg_catalog', **jsonb_codec)
+
+
+async def _rebuild_facets(app):
+    # language=rst
+    """Refill the facet count table, if it's empty or if the materialized
+    facets or their paths changed since it was filled.
+
+    Refilling locks the table and scans all documents, so it isn't done on
+    every startup.
+
+    """
+    ptrs, paths = zip(*app['materialized_facets'])
+    action = _FACETS_ACTION_PREFIX + hashlib.sha1(
+        json.dumps(app['materialized_facets']).encode()
+    ).hexdigest()
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            # Nodes that start at the same time refill the table only once:
+            await con.execute(_Q_LOCK_STARTUP_ACTIONS)
+            if await con.fetchval(_Q_FACETS_FILLED, action):
+                return
+            _logger.info("Refilling the facet count table")
+            await con.execute(_Q_TRUNCATE_FACETS)
+            await con.execute(_Q_REBUILD_FACETS, ptrs, paths, 1)
+            await con.execute(_Q_FORGET_FACETS_FILLED)
+            await con.execute(_Q_ADD_STARTUP_ACTION, action)
+
+
+async def _update_facets(app, con, docids: T.List[str], sign: int):
+    # language=rst
+    """Add (``sign=1``) or subtract (``sign=-1``) the facet values of the
+    given documents to / from the facet count table.
+
+    Must be called within a transaction on ``con``.
+
+    """
+    await _update_doc_facets(con, app['materialized_facets'], docids, sign)
+
+
+async def _update_doc_facets(con, facets: T.List[T.Tuple[str, str]],
+                             docids: T.List[str], sign: int):
+    ptrs, paths = zip(*facets)
+    await con.execute(_Q_UPDATE_DOC_FACETS, ptrs, paths, sign, docids)
+    if sign < 0:
+        await con.execute(_Q_CLEAN_FACETS)
+
+
+async def _stored_facets(con) -> T.List[T.Tuple[str, str]]:
+    # language=rst
+    """The facets in the facet count table, as ``(pointer, path)`` tuples.
+
+    For tools that write documents without the service's configuration:
+    these are the facets that the service materialized, as far as they have
+    any values.
+
+    """
+    return [('/', 'strict $')] + [
+        (row['facet_ptr'], _to_pg_jsonpath(jsonpointer.JsonPointer(row['facet_ptr']).parts))
+        for row in await con.fetch(_Q_STORED_FACETS) if row['facet_ptr'] != '/'
+    ]
+
+
 @_hookimpl
 async def deinitialize(app):
     # language=rst
@@ -196,7 +518,36 @@ async def storage_retrieve(app: T.Mapping[str, T.Any], docid: str, etags: T.Opti
         raise KeyError()
     if etags and conditional.match_etags(record['etag'], etags, True):
         return None, record['etag']
-    return json.loads(record['doc']), record['etag']
+    return record['doc'], record['etag']
+
+
+@_hookimpl
+async def storage_retrieve_many(app: T.Mapping[str, T.Any], docids: T.List[str]) \
+        -> T.Dict[str, T.Tuple[dict, str]]:
+    # language=rst
+    """ Get many documents and their etags at once.
+
+    See :func:`datacatalog.plugin_interfaces.storage_retrieve_many`
+
+    """
+    return {
+        row['id']: (row['doc'], row['etag'])
+        for row in await app['pool'].fetch(_Q_RETRIEVE_MANY_DOCS, list(docids))
+    }
+
+
+@_hookimpl
+async def storage_etag(app: T.Mapping[str, T.Any], docid: str) -> str:
+    # language=rst
+    """ Get the etag of a document.
+
+    See :func:`datacatalog.plugin_interfaces.storage_etag`
+
+    """
+    etag = await app['pool'].fetchval(_Q_RETRIEVE_ETAG, docid)
+    if etag is None:
+        raise KeyError()
+    return etag
 
 
 @_hookimpl
@@ -218,7 +569,9 @@ async def storage_create(app: T.Mapping[str, T.Any], docid: str, doc: dict, sear
     new_etag = _etag_from_str(new_doc)
     lang = _iso_639_1_code_to_pg(iso_639_1_code)
     try:
-        await app['pool'].execute(_Q_INSERT_DOC,
+        async with app['pool'].acquire() as con:
+            async with con.transaction():
+                await con.execute(_Q_INSERT_DOC,
                                   docid,
                                   new_doc,
                                   searchable_text.get('A', ''),
@@ -227,6 +580,7 @@ async def storage_create(app: T.Mapping[str, T.Any], docid: str, doc: dict, sear
                                   searchable_text.get('D', ''),
                                   lang,
                                   new_etag)
+                await _update_facets(app, con, [docid], 1)
     except asyncpg.exceptions.UniqueViolationError as e:
         raise KeyError from e
     return new_etag
@@ -252,7 +606,12 @@ async def storage_update(app: T.Mapping[str, T.Any], docid: str, doc: dict, sear
     """
     new_doc = json.dumps(doc, ensure_ascii=False, sort_keys=True)
     new_etag = _etag_from_str(new_doc)
-    if (await app['pool'].fetchval(_Q_UPDATE_DOC,
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            if (await con.fetchval(_Q_LOCK_DOC, docid)) not in etags:
+                raise ValueError
+            await _update_facets(app, con, [docid], -1)
+            if (await con.fetchval(_Q_UPDATE_DOC,
                                    new_doc,
                                    searchable_text.get('A', ''),
                                    searchable_text.get('B', ''),
@@ -261,10 +620,120 @@ async def storage_update(app: T.Mapping[str, T.Any], docid: str, doc: dict, sear
                                    new_etag,
                                    docid,
                                    list(etags))) is None:
-        raise ValueError
+                raise ValueError
+            await _update_facets(app, con, [docid], 1)
     return new_etag
 
 
+@_hookimpl
+async def storage_create_many(app: T.Mapping[str, T.Any],
+                              docs: T.List[T.Tuple[str, dict, dict, T.Optional[str]]]) \
+        -> T.List[T.Union[str, Exception]]:
+    # language=rst
+    """ Store many new documents in a single transaction.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(docid, doc, searchable_text, iso_639_1_code)``
+        tuples, with the same meaning as the arguments of
+        :func:`storage_create`.
+    :returns: for each document, in order, either its new ETag or a
+        :class:`KeyError` instance if the docid already exists.
+    """
+    results = []
+    rows = {}
+    for docid, doc, searchable_text, iso_639_1_code in docs:
+        if docid in rows:
+            results.append(KeyError(docid))
+            continue
+        new_doc = json.dumps(doc, ensure_ascii=False, sort_keys=True)
+        new_etag = _etag_from_str(new_doc)
+        rows[docid] = (new_doc, searchable_text, _iso_639_1_code_to_pg(iso_639_1_code), new_etag)
+        results.append(new_etag)
+    if len(rows) == 0:
+        return results
+    docids = list(rows.keys())
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            inserted = {
+                row['id'] for row in await con.fetch(
+                    _Q_INSERT_MANY_DOCS,
+                    docids,
+                    [row[0] for row in rows.values()],
+                    *_searchable_text_columns(row[1] for row in rows.values()),
+                    [row[2] for row in rows.values()],
+                    [row[3] for row in rows.values()]
+                )
+            }
+            await _update_facets(app, con, list(inserted), 1)
+    return [
+        KeyError(docid) if isinstance(result, str) and docid not in inserted else result
+        for (docid, *_), result in zip(docs, results)
+    ]
+
+
+@_hookimpl
+async def storage_update_many(app: T.Mapping[str, T.Any],
+                              docs: T.List[T.Tuple[str, dict, dict, T.Set[str], T.Optional[str]]]) \
+        -> T.List[T.Union[str, Exception]]:
+    # language=rst
+    """ Update many documents in a single transaction, each only if it has
+    one of the provided Etags.
+
+    :param app: the `~datacatalog.application.Application`
+    :param docs: a list of ``(docid, doc, searchable_text, etags,
+        iso_639_1_code)`` tuples, with the same meaning as the arguments of
+        :func:`storage_update`.
+    :returns: for each document, in order, either its new ETag, a
+        :class:`KeyError` instance if the docid doesn't exist, or a
+        :class:`ValueError` instance if none of its etags match the stored
+        etag. Documents that fail are left untouched; the others are updated.
+    """
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            # Lock all rows (in a fixed order, to prevent deadlocks) so their
+            # etags can't change between the check and the update.
+            current_etags = {
+                row['id']: row['etag'] for row in await con.fetch(
+                    _Q_LOCK_MANY_DOCS, list({doc[0] for doc in docs}))
+            }
+            results = []
+            rows = {}
+            for docid, doc, searchable_text, etags, iso_639_1_code in docs:
+                if docid not in current_etags:
+                    results.append(KeyError(docid))
+                elif docid in rows or current_etags[docid] not in etags:
+                    # a second update of the same document within this batch
+                    # can't have been based on the first one.
+                    results.append(ValueError(docid))
+                else:
+                    new_doc = json.dumps(doc, ensure_ascii=False, sort_keys=True)
+                    new_etag = _etag_from_str(new_doc)
+                    rows[docid] = (new_doc, searchable_text, new_etag)
+                    results.append(new_etag)
+            if len(rows) == 0:
+                return results
+            docids = list(rows.keys())
+            await _update_facets(app, con, docids, -1)
+            await con.execute(
+                _Q_UPDATE_MANY_DOCS,
+                docids,
+                [row[0] for row in rows.values()],
+                *_searchable_text_columns(row[1] for row in rows.values()),
+                [row[2] for row in rows.values()],
+                [row[3] for row in rows.values()]
+            )
+            await _update_facets(app, con, docids, 1)
+    return results
+
+
+def _searchable_text_columns(searchable_texts: T.Iterable[dict]) -> T.List[T.List[str]]:
+    searchable_texts = list(searchable_texts)
+    return [
+        [searchable_text.get(weight, '') for searchable_text in searchable_texts]
+        for weight in 'ABCD'
+    ]
+
+
 @_hookimpl
 async def storage_delete(app: T.Mapping[str, T.Any], docid: str, etags: T.Set[str]) -> None:
     # language=rst
@@ -277,17 +746,17 @@ async def storage_delete(app: T.Mapping[str, T.Any], docid: str, etags: T.Set[st
     :raises KeyError: if a document with the given id doesn't exist.
 
     """
-    if (await app['pool'].fetchval(_Q_DELETE_DOC, docid, etags)) is None:
-        # the operation may fail because either the id doesn't exist or the given
-        # etag doesn't match. There's no way to atomically check for both
-        # conditions at the same time, apart from a full table lock. However,
-        # all scenario's in which the below, not threat-safe way of identifying
-        # the cause of failure is not correct, are trivial.
-        #
-        # TODO: don't call storage_retrieve() directly, but through the plugin manager.
-        _, etag = await storage_retrieve(app, docid, etags)  # this may raise a KeyError
-        assert etag not in etags
-        raise ValueError
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            # Lock the row, so that we can tell a missing document from a
+            # mismatching etag and keep the facet counts consistent.
+            etag = await con.fetchval(_Q_LOCK_DOC, docid)
+            if etag is None:
+                raise KeyError()
+            if etag not in etags:
+                raise ValueError
+            await _update_facets(app, con, [docid], -1)
+            await con.execute(_Q_DELETE_DOC, docid, etags)
 
 
 def _extract_values(elm, ptr_parts, ptr_idx=0):
@@ -319,6 +788,34 @@ def _extract_values(elm, ptr_parts, ptr_idx=0):
         raise ValueError('Element must be either list, object or end of pointer, not: ' + part)
 
 
+def _to_pg_jsonpath(ptr_parts: T.List[str]) -> str:
+    """Translate a JSON pointer into a strict SQL/JSON path expression that
+    matches the same values as :func:`_extract_values`.
+
+    In strict mode, a missing key or a non-array is an error that ends the
+    evaluation of the whole path, so every step is guarded by a filter that
+    skips the items it doesn't apply to. Lax mode would skip them, but also
+    unwrap arrays and wrap scalars, which :func:`_extract_values` doesn't.
+
+    """
+    path = 'strict $'
+    ptr_idx = 0
+    while ptr_idx < len(ptr_parts):
+        part = ptr_parts[ptr_idx]
+        if part == 'properties':
+            if ptr_idx == len(ptr_parts) - 1:
+                raise ValueError('Properties must be followed by property name')
+            key = json.dumps(ptr_parts[ptr_idx + 1], ensure_ascii=False)
+            path += ' ? (exists(@.{0})).{0}'.format(key)
+            ptr_idx += 2
+        elif part == 'items':
+            path += ' ? (@.type() == "array")[*]'
+            ptr_idx += 1
+        else:
+            raise ValueError('Element must be either list, object or end of pointer, not: ' + part)
+    return path
+
+
 @_hookimpl
 async def storage_extract(app: T.Mapping[str, T.Any], ptr: str, distinct: bool=False) -> T.Generator[str, None, None]:
     # language=rst
@@ -327,7 +824,9 @@ async def storage_extract(app: T.Mapping[str, T.Any], ptr: str, distinct: bool=F
 
     Used to, for example, get a list of all tags or ids in the system. Or to
     get all documents stored in the system. If distinct=True then the generator
-    will cache all values in a set, which may become prohibitively large.
+    will cache all values in a set, which may become prohibitively large,
+    unless ``ptr`` is one of the materialized facets: then the values are read
+    from the facet table, as strings.
 
     :param app: the `~datacatalog.application.Application`
     :param ptr: JSON pointer to the element.
@@ -340,7 +839,14 @@ async def storage_extract(app: T.Mapping[str, T.Any], ptr: str, distinct: bool=F
             async with con.transaction():
                 # use a cursor so we can stream
                 async for row in con.cursor(_Q_RETRIEVE_ALL_DOCS):
-                    yield json.loads(row['doc'])
+                    yield row['doc']
+        return
+
+    # Distinct values of materialized facets are already in the facet table
+    if distinct and ptr in (facet_ptr for facet_ptr, path in app['materialized_facets']):
+        async with app['pool'].acquire() as con:
+            for row in await con.fetch(_Q_DISTINCT_FACET_VALUES, ptr):
+                yield row['value']
         return
 
     # Otherwise, return the values
@@ -355,7 +861,7 @@ async def storage_extract(app: T.Mapping[str, T.Any], ptr: str, distinct: bool=F
         async with con.transaction():
             # use a cursor so we can stream
             async for row in con.cursor(_Q_RETRIEVE_ALL_DOCS):
-                doc = json.loads(row['doc'])
+                doc = row['doc']
                 for elm in _extract_values(doc, ptr_parts):
                     if not distinct or elm not in cache:
                         yield elm
@@ -383,6 +889,7 @@ async def search_search(
     result_info: T.MutableMapping,
     facets: T.Optional[T.Iterable[str]]=None,
     limit: T.Optional[int]=None, offset: int=0,
+    after: T.Optional[T.Tuple[str, str]]=None,
     filters: T.Optional[T.Mapping[
         str,  # a JSON pointer
         T.Mapping[
@@ -392,8 +899,12 @@ async def search_search(
             T.Union[str, T.Set[str]]
         ]
     ]]=None,
-    iso_639_1_code: T.Optional[str]=None
-) -> T.AsyncGenerator[T.Tuple[str, dict], None]:
+    iso_639_1_code: T.Optional[str]=None,
+    summary: bool=False,
+    render_version: T.Optional[str]=None,
+    fields: T.Optional[T.List[str]]=None,
+    sort_key: bool=False
+) -> T.AsyncGenerator[T.Tuple, None]:
     # language=rst
     """ Search
 
@@ -408,87 +919,227 @@ async def search_search(
             facets = [(f, jsonpointer.JsonPointer(f)) for f in facets]
         except jsonpointer.JsonPointerException:
             raise ValueError('Cannot parse pointer')
+    # check the paging parameters
+    if offset is None:
+        offset = 0
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError('Limit and offset must not be negative')
+    if after is not None and len(q) > 0:
+        raise ValueError('Keyset pagination is only supported for listings')
     # interpret the filters
-    filterexpr = _to_pg_json_filterexpression(filters)
+    args = []
+    filterexpr = _to_pg_json_filterexpression(filters, args)
     # interpret the language
     lang = _to_pg_lang(iso_639_1_code)
-    # init paging parameters
-    start, end = offset, offset+limit if limit is not None else float('inf')
-    # keep track of the current row index
-    row_index = 0
     # if we have a query we should perform a free-text search ordered by
     # relevance, otherwise we should do a sorted listing.
     if len(q) > 0:
-        result_iterator = _execute_search_query(app, filterexpr, q)
+        q = _sanitize_query(q)
+        prefix = _bind(args, _to_pg_json_query(q))
+        where = _Q_SEARCH_WHERE.format(prefix=prefix, filters=filterexpr)
     else:
-        result_iterator = _execute_list_query(app, filterexpr, lang, sortpath)
-    # now iterate over the results
-    async for docid, doc in result_iterator:
-        # update the result info
-        for facet, ptr in facets:
-            if facet not in result_info:
-                result_info[facet] = {}
-            ptr_parts = ptr.parts
-            for value in _extract_values(doc, ptr_parts):
-                value = str(value)
-                if value not in result_info[facet]:
-                    result_info[facet][value] = 1
-                else:
-                    result_info[facet][value] += 1
-        # yield the result if it falls within the current page
-        if start <= row_index < end:
-            yield (docid, doc)
+        where = _Q_LIST_WHERE.format(lang=_bind(args, lang), filters=filterexpr)
+    async with app['pool'].acquire() as con:
+        # The total amount of documents and the facets are computed over the
+        # whole result set; only the requested page is actually fetched.
+        materialized, statuses = _materialized_status_filter(app, q, facets, filters)
+        if materialized:
+            result_info['/'] = await _count_materialized_facets(
+                con, facets, statuses, lang, result_info)
+        elif len(facets) > 0:
+            result_info['/'] = await _count_facets(
+                con, where, args, facets, result_info)
+        else:
+            result_info['/'] = await con.fetchval(
+                _Q_COUNT_DOCS.format(where=where), *args)
+        if len(q) > 0:
+            result_iterator = _execute_search_query(
+                con, where, args, prefix, q, limit, offset, summary, render_version, fields,
+                sort_key)
+        else:
+            result_iterator = _execute_list_query(
+                con, where, args, sortpath, limit, offset, after, summary, render_version, fields,
+                sort_key)
+        async for result in result_iterator:
+            yield result
 
-        row_index += 1
-    # store the total amount of documents in the result info
-    result_info['/'] = row_index
+
+def _bind(args: list, value: T.Any) -> str:
+    # language=rst
+    """Append a bind parameter to ``args`` and return its placeholder."""
+    args.append(value)
+    return '$%d' % len(args)
+
+
+async def _count_facets(con, where: str, args: list,
+                        facets: T.List[T.Tuple[str, jsonpointer.JsonPointer]],
+                        result_info: T.MutableMapping) -> int:
+    args = list(args)
+    query = _Q_FACET_COUNTS.format(
+        where=where,
+        ptrs=_bind(args, [facet for facet, ptr in facets]),
+        paths=_bind(args, [_to_pg_jsonpath(ptr.parts) for facet, ptr in facets])
+    )
+    for facet, ptr in facets:
+        # Facets without values are in the result info too:
+        result_info.setdefault(facet, {})
+    row_count = 0
+    for row in await con.fetch(query, *args):
+        if row['facet'] == '/':
+            row_count = row['count']
+        else:
+            result_info.setdefault(row['facet'], {})[row['value']] = row['count']
+    return row_count
+
+
+def _materialized_status_filter(app, q: str, facets, filters: T.Optional[dict]) \
+        -> T.Tuple[bool, T.Optional[T.List[str]]]:
+    # language=rst
+    """Check whether the facets can be read from the facet count table.
+
+    That's the case for listings (no full-text query) of materialized facets,
+    filtered on ``ams:status`` at most.
+
+    :returns: a tuple. The first element tells whether the facet count table
+        can be used, the second is the list of statuses to count, or ``None``
+        for all statuses.
+
+    """
+    if len(q) > 0 or len(facets) == 0:
+        return False, None
+    materialized = {ptr for ptr, path in app['materialized_facets']}
+    if any(facet not in materialized for facet, ptr in facets):
+        return False, None
+    statuses = None
+    for ptr, filter in (filters or {}).items():
+        if ptr != '/properties/ams:status':
+            return False, None
+        for op, val in filter.items():
+            if op == 'eq':
+                values = {val}
+            elif op == 'in':
+                values = set(val)
+            else:
+                return False, None
+            statuses = values if statuses is None else statuses & values
+    return True, None if statuses is None else list(statuses)
+
+
+async def _count_materialized_facets(con, facets, statuses: T.Optional[T.List[str]],
+                                     lang: str, result_info: T.MutableMapping) -> int:
+    for facet, ptr in facets:
+        result_info.setdefault(facet, {})
+    row_count = 0
+    for row in await con.fetch(_Q_MATERIALIZED_FACET_COUNTS,
+                               ['/'] + [facet for facet, ptr in facets],
+                               statuses, lang):
+        if row['facet'] == '/':
+            row_count = row['count']
+        else:
+            result_info.setdefault(row['facet'], {})[row['value']] = row['count']
+    return row_count
 
 
-async def _execute_list_query(app, filterexpr: str, lang: str, sortpath: T.List[str]):
+async def _execute_list_query(con, where: str, args: list, sortpath: T.List[str],
+                              limit: T.Optional[int], offset: int,
+                              after: T.Optional[T.Tuple[str, str]], summary: bool,
+                              render_version: T.Optional[str], fields: T.Optional[T.List[str]],
+                              sort_key: bool):
     if len(sortpath) == 0:
         raise ValueError('Sortpath should not be empty')
-    sortexpr = 'doc->'
-    for p in sortpath[:-1]:
-        sortexpr += "'" + p + "'->"
-    sortexpr += ">'" + sortpath[-1] + "'"
-    async with app['pool'].acquire() as con:
-        # use a cursor so we can stream
-        async with con.transaction():
-            stmt = await con.prepare(
-                _Q_LIST_DOCS.format(filters=filterexpr, sortexpression=sortexpr)
-            )
-            async for row in stmt.cursor(lang):
-                yield row['id'], json.loads(row['doc'])
+    args = list(args)
+    sortexpr = _SORT_COLUMNS.get(tuple(sortpath))
+    if sortexpr is None:
+        sortexpr = _Q_SORT_EXPRESSION.format(path=_bind(args, list(sortpath)))
+    seek = ''
+    if after is not None:
+        seek = _Q_LIST_SEEK.format(
+            sortexpression=sortexpr,
+            sort_value=_bind(args, after[0]), id=_bind(args, after[1])
+        )
+    columns = _result_columns(args, summary, render_version, fields)
+    if sort_key:
+        columns += ', ' + sortexpr + ' AS sort_key'
+    query = _Q_LIST_DOCS.format(
+        columns=columns,
+        where=where, seek=seek, sortexpression=sortexpr,
+        limit=_bind(args, limit), offset=_bind(args, offset)
+    )
+    # use a cursor so we can stream; statements are prepared through the
+    # connection's statement cache.
+    async with con.transaction():
+        async for row in con.cursor(query, *args):
+            yield _result(row, render_version, sort_key)
+
+
+async def _execute_search_query(con, where: str, args: list, prefix: str, q: str,
+                                limit: T.Optional[int], offset: int, summary: bool,
+                                render_version: T.Optional[str], fields: T.Optional[T.List[str]],
+                                sort_key: bool):
+    args = list(args)
+    columns = _result_columns(args, summary, render_version, fields)
+    if sort_key:
+        # Search results are ordered by rank:
+        columns += ', NULL::text AS sort_key'
+    query = _Q_SEARCH_DOCS.format(
+        columns=columns,
+        where=where, prefix=prefix,
+        fullmatch=_bind(args, _to_pg_json_query_fullmatch(q)),
+        limit=_bind(args, limit), offset=_bind(args, offset)
+    )
+    # use a cursor so we can stream; statements are prepared through the
+    # connection's statement cache.
+    async with con.transaction():
+        async for row in con.cursor(query, *args):
+            yield _result(row, render_version, sort_key)
+
+
+def _result_columns(args: list, summary: bool, render_version: T.Optional[str],
+                    fields: T.Optional[T.List[str]]=None) -> str:
+    if render_version is None:
+        return 'doc'
+    rendered = 'rendered_summary' if summary else 'rendered'
+    if fields is not None:
+        rendered = _Q_PROJECTION.format(doc=rendered, keys=_bind(args, list(fields)))
+    current = _Q_RENDITION_IS_CURRENT.format(version=_bind(args, render_version) + '::text')
+    return _Q_RENDITION_COLUMNS.format(current=current, rendered=rendered)
+
+
+def _result(row, render_version: T.Optional[str], sort_key: bool) -> T.Tuple:
+    if render_version is None:
+        result = row['id'], row['doc']
+    else:
+        result = row['id'], row['doc'], row['rendered']
+    if sort_key:
+        result += (row['sort_key'],)
+    return result
 
 
-async def _execute_search_query(app, filterexpr: str, q: str):
+def _sanitize_query(q: str) -> str:
     # Replace .,\'"|&:()*!\/ with spaces
-    q = re.sub('[\\\\/.,\'"|&:()*!<>;\[\]{}]', ' ', q)
-    prefix_query = _to_pg_json_query(q)
-    fullmatch_query = _to_pg_json_query_fullmatch(q)
+    return re.sub('[\\\\/.,\'"|&:()*!<>;\[\]{}]', ' ', q)
 
-    async with app['pool'].acquire() as con:
-        # use a cursor so we can stream
-        async with con.transaction():
-            stmt = await con.prepare(
-                _Q_SEARCH_DOCS.format(filters=filterexpr)
-            )
-            async for row in stmt.cursor(prefix_query, fullmatch_query):
-                yield row['id'], json.loads(row['doc'])
 
+def _to_pg_json_filterexpression(filters: T.Optional[dict], args: list) -> str:
+    # language=rst
+    """Translate the filters into a SQL expression.
+
+    All values are passed as bind parameters, which are appended to ``args``.
+    The resulting SQL only depends on the structure of the filters, so that
+    repeated facet queries can reuse their prepared statements.
 
-def _to_pg_json_filterexpression(filters: T.Optional[dict]) -> str:
+    """
     if filters is None:
         return ''
 
-    def to_expr(ptr: str, value: T.Any) -> str:
-        """Create a filterexpression from a json pointer and value."""
+    def to_value(ptr: str, value: T.Any) -> T.Any:
+        """Create the JSON value to test containment of, from a json pointer
+        and value."""
         try:
             p = jsonpointer.JsonPointer(ptr)
         except jsonpointer.JsonPointerException:
             raise ValueError('Cannot parse pointer')
         parts = collections.deque(p.parts)
-        value = json.dumps(value)
 
         def parse_complex_type():
             nxt = parts.popleft()
@@ -499,22 +1150,22 @@ def _to_pg_json_filterexpression(filters: T.Optional[dict]) -> str:
             raise ValueError('Child must be either list, '
                              'object or end of pointer, not: ' + nxt)
 
-        def parse_obj() -> str:
+        def parse_obj() -> dict:
             if len(parts) == 0:
                 raise ValueError('Properties must be followed by property name')
-            name = json.dumps(parts.popleft())
+            name = parts.popleft()
             # either end-of-pointer primitive...
             if len(parts) == 0:
-                return '{' + name + ': ' + value + '}'
+                return {name: value}
             # or a complex type
-            return '{' + name + ': ' + parse_complex_type() + '}'
+            return {name: parse_complex_type()}
 
-        def parse_list() -> str:
+        def parse_list() -> list:
             # either end-of-pointer primitive...
             if len(parts) == 0:
-                return '[' + value + ']'
+                return [value]
             # or a complex type
-            return '[' + parse_complex_type() + ']'
+            return [parse_complex_type()]
 
         # base case: query json document with solely a single primitive
         # (string, int, bool, ...)
@@ -524,6 +1175,9 @@ def _to_pg_json_filterexpression(filters: T.Optional[dict]) -> str:
         # anything else must be a complex type (object or list)
         return parse_complex_type()
 
+    def to_expr(ptr: str, value: T.Any) -> str:
+        return 'doc @> ' + _bind(args, json.dumps(to_value(ptr, value))) + '::jsonb'
+
     # Interpret the filters
     filterexprs = []
     for ptr, filter in filters.items():
@@ -532,14 +1186,17 @@ def _to_pg_json_filterexpression(filters: T.Optional[dict]) -> str:
                 raise NotImplementedError(
                     'Postgres plugin only supports '
                     '"eq" and "in" filter operators')
-            if op == "eq":
+            values = [val] if op == 'eq' else list(val)
+            if ptr in _FILTER_COLUMNS and all(isinstance(v, str) for v in values):
                 filterexprs.append(
-                    " AND doc @> '" + to_expr(ptr, val) + "'")
+                    ' AND ' + _FILTER_COLUMNS[ptr] + ' = ANY(' + _bind(args, values) + '::text[])')
+            elif op == "eq":
+                filterexprs.append(' AND ' + to_expr(ptr, val))
             elif op == "in":
-                orexpr = ' OR '.join(
-                    "doc @> '" + to_expr(ptr, v) + "'" for v in val
-                )
-                filterexprs.append(' AND (' + orexpr + ')')
+                # An OR-chain (instead of ``@> ANY(...)``) lets Postgres use
+                # the GIN index on doc.
+                orexpr = ' OR '.join(to_expr(ptr, v) for v in val)
+                filterexprs.append(' AND (' + (orexpr or 'FALSE') + ')')
     return ''.join(filterexprs)
 
 
@@ -615,9 +1272,8 @@ async def check_startup_action(app: T.Mapping[str, T.Any], name: str) -> bool:
 
 @_hookimpl
 async def add_startup_action(app: T.Mapping[str, T.Any], name: str):
-    _Q = 'INSERT INTO "dcatd_startup_actions" (action) VALUES ($1)'
     async with app['pool'].acquire() as con:
-        await con.execute(_Q, name)
+        await con.execute(_Q_ADD_STARTUP_ACTION, name)
 
 
 @_hookimpl
@@ -630,12 +1286,88 @@ async def get_old_identifiers(app: T.Mapping[str, T.Any]):
 
 @_hookimpl
 async def set_new_identifier(app: T.Mapping[str, T.Any], old_id: str, new_id: str):
-    _Q = 'UPDATE dataset SET id = $1 WHERE id = $2'
+    # The rendition contains the old @id and purls:
+    _Q = 'UPDATE dataset SET id = $1, ' + _Q_CLEAR_RENDITION + ' WHERE id = $2'
     async with app['pool'].acquire() as con:
-        result = await con.execute(_Q, new_id, old_id)
+        async with con.transaction():
+            await _update_facets(app, con, [old_id], -1)
+            result = await con.execute(_Q, new_id, old_id)
+            await _update_facets(app, con, [new_id], 1)
         return result
 
 
+@_hookimpl
+async def storage_retrieve_rendition(app: T.Mapping[str, T.Any], docid: str, version: str) \
+        -> T.Tuple[T.Optional[dict], str]:
+    # language=rst
+    """ Get the rendition of a document and its etag.
+
+    See :func:`datacatalog.plugin_interfaces.storage_retrieve_rendition`
+
+    """
+    async with app['pool'].acquire() as con:
+        record = await con.fetchrow(_Q_RETRIEVE_RENDITION, docid, version)
+    if record is None:
+        raise KeyError()
+    return record['rendered'], record['etag']
+
+
+@_hookimpl
+async def storage_store_rendition(app: T.Mapping[str, T.Any], docid: str, etag: str,
+                                  version: str, rendition: dict, summary: dict) -> bool:
+    # language=rst
+    """ Store the rendition of a document, if it still has the given etag.
+
+    See :func:`datacatalog.plugin_interfaces.storage_store_rendition`
+
+    """
+    async with app['pool'].acquire() as con:
+        return (await con.fetchval(
+            _Q_STORE_RENDITION, docid, etag, rendition, summary, version
+        )) is not None
+
+
+@_hookimpl
+async def storage_store_rendition_many(app: T.Mapping[str, T.Any], version: str,
+                                       renditions: T.List[T.Tuple[str, str, dict, dict]]) \
+        -> T.List[bool]:
+    # language=rst
+    """ Store many renditions in one statement.
+
+    See :func:`datacatalog.plugin_interfaces.storage_store_rendition_many`
+
+    """
+    if len(renditions) == 0:
+        return []
+    async with app['pool'].acquire() as con:
+        stored = {
+            row['id'] for row in await con.fetch(
+                _Q_STORE_MANY_RENDITIONS,
+                [docid for docid, etag, rendition, summary in renditions],
+                [etag for docid, etag, rendition, summary in renditions],
+                [json.dumps(rendition, ensure_ascii=False) for docid, etag, rendition, summary in renditions],
+                [json.dumps(summary, ensure_ascii=False) for docid, etag, rendition, summary in renditions],
+                version
+            )
+        }
+    return [docid in stored for docid, etag, rendition, summary in renditions]
+
+
+@_hookimpl
+async def storage_stale_renditions(app: T.Mapping[str, T.Any], version: str) \
+        -> T.AsyncGenerator[T.Tuple[str, str, dict], None]:
+    # language=rst
+    """ All documents without a rendition of the given version.
+
+    See :func:`datacatalog.plugin_interfaces.storage_stale_renditions`
+
+    """
+    async with app['pool'].acquire() as con:
+        async with con.transaction():
+            async for row in con.cursor(_Q_STALE_RENDITIONS, version):
+                yield row['id'], row['etag'], row['doc']
+
+
 @_hookimpl
 async def storage_all(app: T.Mapping[str, T.Any]) -> T.AsyncGenerator[T.Tuple[str, str, dict], None]:
     # language=rst
@@ -644,4 +1376,4 @@ async def storage_all(app: T.Mapping[str, T.Any]) -> T.AsyncGenerator[T.Tuple[st
         async with con.transaction():
             stmt = await con.prepare(_Q)
             async for row in stmt.cursor():
-                yield row['id'], row['etag'], json.loads(row['doc'])
+                yield row['id'], row['etag'], row['doc']
@@ -0,0 +1,334 @@
+# language=rst
+"""Rendering of stored datasets into the representation that is served.
+
+Rendering a dataset (:meth:`mds_canonicalize` followed by
+:meth:`mds_after_storage`) is expensive, and its result only changes when the
+dataset is written. Storage plugins therefore keep the rendition of each
+dataset, together with the :func:`version` of the rendering it was made with.
+A rendition with another version (because the code, the schema, the context or
+the base URL changed) is stale, and is replaced in the background by
+:func:`rerender_stale`.
+
+Serialized renditions are also kept in memory, in a :class:`BodyCache`.
+
+"""
+import collections
+import hashlib
+import json
+import logging
+import typing as T
+
+from aiohttp import web
+
+from datacatalog import dcat
+
+_logger = logging.getLogger(__name__)
+
+RENDERING_VERSION = 1
+# language=rst
+"""Part of the :func:`version` of the rendering. Increment it when a change of
+the code changes renditions, for example of :meth:`mds_after_storage`,
+:meth:`mds_canonicalize` or :func:`summarize`, in a way that the schema of
+datasets doesn't reflect."""
+
+BATCH_SIZE = 100
+# language=rst
+"""Number of datasets that :func:`render_missing` and :func:`rerender_stale`
+render at once."""
+
+SUMMARY_KEYS = {
+    '@id', 'dct:identifier', 'dct:title', 'dct:description', 'dcat:keyword',
+    'foaf:isPrimaryTopicOf', 'dcat:distribution', 'dcat:theme', 'ams:owner',
+    'ams:sort_modified', 'ams:status'
+}
+# language=rst
+"""Properties of a rendered dataset that are shown in list views."""
+
+SUMMARY_DISTRIBUTION_KEYS = {
+    'dcat:mediaType', 'ams:resourceType', 'ams:distributionType',
+    'ams:serviceType', 'dc:identifier'
+}
+# language=rst
+"""Properties of a rendered distribution that are shown in list views."""
+
+SUMMARY_FIELDS = dict(
+    {key: None for key in SUMMARY_KEYS},
+    **{'dcat:distribution': {key: None for key in SUMMARY_DISTRIBUTION_KEYS}}
+)
+# language=rst
+"""The projection (see :data:`datacatalog.dcat.Projection`) of a dataset that is
+needed for its :func:`summarize`."""
+
+BODY_CACHE_SIZE = 64 * 1024 * 1024
+# language=rst
+"""Number of bytes of serialized renditions in a :class:`BodyCache`."""
+
+CachedBody = collections.namedtuple('CachedBody', 'etag version status body')
+# language=rst
+"""A serialized rendition, with the etag of the dataset, the :func:`version` of
+the rendering and the ``ams:status`` of the dataset."""
+
+
+class BodyCache(object):
+    # language=rst
+    """Bounded LRU cache of serialized renditions, by document id.
+
+    The size of the cache is the total length of the bodies. Entries carry the
+    etag of the dataset they were rendered from; it's up to the caller to
+    check that against the current etag.
+
+    """
+
+    def __init__(self, maxbytes: int=BODY_CACHE_SIZE):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self._bodies: T.MutableMapping[str, CachedBody] = collections.OrderedDict()
+
+    def get(self, docid: str, version: str) -> T.Optional[CachedBody]:
+        # language=rst
+        """The cached body of ``docid``, if it was rendered with ``version``."""
+        cached = self._bodies.get(docid)
+        if cached is None:
+            return None
+        if cached.version != version:
+            # Renditions of another version won't be used again; free their
+            # space:
+            self.discard(docid)
+            return None
+        self._bodies.move_to_end(docid)
+        return cached
+
+    def put(self, docid: str, etag: str, version: str, rendition: dict) -> CachedBody:
+        # language=rst
+        """Serialize and cache a rendition.
+
+        :returns: the new entry, even if its body is larger than the cache.
+
+        """
+        self.discard(docid)
+        cached = CachedBody(etag, version, rendition.get('ams:status'),
+                            json.dumps(rendition).encode())
+        if len(cached.body) > self.maxbytes:
+            return cached
+        self._bodies[docid] = cached
+        self.size += len(cached.body)
+        while self.size > self.maxbytes:
+            _docid, evicted = self._bodies.popitem(last=False)
+            self.size -= len(evicted.body)
+        return cached
+
+    def discard(self, docid: str):
+        cached = self._bodies.pop(docid, None)
+        if cached is not None:
+            self.size -= len(cached.body)
+
+
+async def version(app: web.Application) -> str:
+    # language=rst
+    """The version of the rendering.
+
+    Renditions depend on the code (see :data:`RENDERING_VERSION`), the schema
+    of datasets, the list view properties, the JSON-LD context and the base URL
+    (for the persistent URLs of distributions), so a change of any of them
+    makes all renditions stale.
+
+    """
+    ctx = await app.hooks.mds_context()
+    schema = await app.hooks.mds_json_schema(app=app, method='GET')
+    h = hashlib.sha1()
+    h.update(str(RENDERING_VERSION).encode())
+    h.update(json.dumps(schema, sort_keys=True).encode())
+    h.update(json.dumps(SUMMARY_FIELDS, sort_keys=True).encode())
+    h.update(json.dumps(ctx, sort_keys=True).encode())
+    h.update(app.config['web']['baseurl'].encode())
+    return h.hexdigest()
+
+
+async def render(app: web.Application, docid: str, doc: dict) -> dict:
+    # language=rst
+    """Render a dataset as it is stored into the representation that is served."""
+    canonical_doc = await app.hooks.mds_canonicalize(app=app, data=doc)
+    return await app.hooks.mds_after_storage(app=app, data=canonical_doc, doc_id=docid)
+
+
+async def render_many(app: web.Application, docs: T.List[T.Tuple[str, dict]],
+                      fields: T.Optional[dict]=None) -> T.List[dict]:
+    # language=rst
+    """Render many datasets at once, like :func:`render`.
+
+    :param fields: a projection of the datasets, to render only the properties
+        that are needed. Renditions of a projection must not be stored.
+
+    """
+    canonical_docs = await app.hooks.mds_canonicalize_many(app=app, docs=docs, fields=fields)
+    return await app.hooks.mds_after_storage_many(app=app, docs=[
+        (docid, canonical_doc)
+        for (docid, doc), canonical_doc in zip(docs, canonical_docs)
+    ])
+
+
+async def render_missing(app: web.Application,
+                         results: T.AsyncIterator[T.Tuple],
+                         fields: T.Optional[dict]=None) -> T.AsyncIterator[T.Tuple]:
+    # language=rst
+    """Fill in the missing renditions in search results.
+
+    Search results with a ``render_version`` are ``(docid, doc, rendition)``
+    tuples (possibly followed by more elements, like the sort key), in which
+    either ``doc`` or ``rendition`` is ``None``. This generator yields the same
+    tuples, with the rendition of ``doc`` when it was missing. Results are rendered in batches of :data:`BATCH_SIZE`, with the
+    projection ``fields`` if given (see :func:`render_many`).
+
+    """
+    batch = []
+
+    async def flush():
+        missing = [(docid, doc) for docid, doc, rendition, *rest in batch if rendition is None]
+        renditions = iter(await render_many(app, missing, fields)) if len(missing) > 0 else None
+        return [
+            (docid, doc, next(renditions) if rendition is None else rendition, *rest)
+            for docid, doc, rendition, *rest in batch
+        ]
+
+    async for result in results:
+        batch.append(result)
+        if len(batch) >= BATCH_SIZE:
+            for rendered in await flush():
+                yield rendered
+            batch = []
+    for rendered in await flush():
+        yield rendered
+
+
+def parse_fields(value: str, schema: dict) -> dcat.Projection:
+    # language=rst
+    """Parse the value of a ``fields`` query parameter into a projection.
+
+    The value is a comma separated list of property names, in which properties
+    of nested objects are selected with a path like
+    ``dcat:distribution/dcat:mediaType``.
+
+    :param schema: the JSON schema of rendered datasets, to validate the
+        property names against. JSON-LD keywords like ``@id`` are always
+        allowed.
+    :raises ValueError: if a property name is unknown.
+
+    """
+    retval = {}
+    for field in value.split(','):
+        names = field.strip().split('/')
+        projection, field_schema = retval, schema
+        for index, name in enumerate(names):
+            while field_schema.get('type') == 'array':
+                field_schema = field_schema['items']
+            properties = field_schema.get('properties', {})
+            if not name.startswith('@') and name not in properties:
+                raise ValueError("Unknown field {}".format(field.strip()))
+            field_schema = properties.get(name, {})
+            if index == len(names) - 1:
+                projection[name] = None
+            elif name in projection and projection[name] is None:
+                # The whole value was already selected
+                break
+            else:
+                projection = projection.setdefault(name, {})
+    return retval
+
+
+def union(a: T.Optional[dcat.Projection], b: T.Optional[dcat.Projection]) \
+        -> T.Optional[dcat.Projection]:
+    # language=rst
+    """The projection that selects what either ``a`` or ``b`` selects."""
+    if a is None or b is None:
+        return None
+    retval = dict(a)
+    for key, value in b.items():
+        retval[key] = union(retval[key], value) if key in retval else value
+    return retval
+
+
+def project(value: T.Any, fields: T.Optional[dcat.Projection]) -> T.Any:
+    # language=rst
+    """The part of a rendition that is selected by ``fields``."""
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, fields) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {
+        key: project(item, fields[key])
+        for key, item in value.items() if key in fields
+    }
+
+
+def summarize(rendition: dict) -> dict:
+    # language=rst
+    """The list view projection of a rendered dataset."""
+    summary = {
+        key: value for key, value in rendition.items() if key in SUMMARY_KEYS
+    }
+    if 'dcat:distribution' in summary:
+        summary['dcat:distribution'] = [
+            {key: value for key, value in distribution.items()
+             if key in SUMMARY_DISTRIBUTION_KEYS}
+            for distribution in summary['dcat:distribution']
+        ]
+    return summary
+
+
+async def store(app: web.Application, docid: str, etag: str, doc: dict) -> dict:
+    # language=rst
+    """Render a stored dataset and store the rendition.
+
+    The rendition is only stored if the dataset still has the given etag.
+
+    :returns: the rendition.
+
+    """
+    rendition = await render(app, docid, doc)
+    await app.hooks.storage_store_rendition(
+        app=app, docid=docid, etag=etag, version=app['render_version'],
+        rendition=rendition, summary=summarize(rendition)
+    )
+    return rendition
+
+
+async def store_many(app: web.Application, docs: T.List[T.Tuple[str, str, dict]]) -> T.List[dict]:
+    # language=rst
+    """Render many stored datasets and store their renditions at once, like
+    :func:`store`.
+
+    :param docs: a list of ``(docid, etag, doc)`` tuples.
+    :returns: the renditions, in order.
+
+    """
+    if len(docs) == 0:
+        return []
+    renditions = await render_many(app, [(docid, doc) for docid, etag, doc in docs])
+    await app.hooks.storage_store_rendition_many(
+        app=app, version=app['render_version'], renditions=[
+            (docid, etag, rendition, summarize(rendition))
+            for (docid, etag, doc), rendition in zip(docs, renditions)
+        ]
+    )
+    return renditions
+
+
+async def rerender_stale(app: web.Application):
+    # language=rst
+    """Replace all missing and stale renditions, in batches of
+    :data:`BATCH_SIZE`."""
+    count = 0
+    batch = []
+    async for docid, etag, doc in await app.hooks.storage_stale_renditions(
+            app=app, version=app['render_version']):
+        batch.append((docid, etag, doc))
+        if len(batch) >= BATCH_SIZE:
+            await store_many(app, batch)
+            count += len(batch)
+            batch = []
+    await store_many(app, batch)
+    count += len(batch)
+    if count > 0:
+        _logger.info("Rendered %d datasets", count)
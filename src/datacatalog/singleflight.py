@@ -0,0 +1,63 @@
+# language=rst
+"""Coalescing of concurrent identical computations.
+
+When many requests for the same resource arrive at once, each of them would
+otherwise do the same storage reads and rendering. A :class:`Group` runs one
+computation per key at a time, and lets all callers with that key await its
+result.
+
+"""
+import asyncio
+import typing as T
+
+
+class Group(object):
+    # language=rst
+    """A set of computations in flight, by key.
+
+    Callers that share a computation also share its result, so results must
+    not be modified.
+
+    """
+
+    def __init__(self):
+        self._flights: T.Dict[T.Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    async def do(self, key: T.Hashable, fn: T.Callable[..., T.Awaitable],
+                 *args: T.Any) -> T.Any:
+        # language=rst
+        """The result of ``fn(*args)``, or of the call with the same key that
+        is already in flight.
+
+        The computation isn't cancelled if a caller is: the other callers may
+        still be waiting for it.
+
+        :raises Exception: whatever ``fn`` raised.
+
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(fn(*args))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda f: self._land(key, f))
+        return await asyncio.shield(flight)
+
+    def forget(self, key: T.Hashable):
+        # language=rst
+        """Let the next call with ``key`` start a new computation.
+
+        Call this after a write that the computation in flight might not see.
+
+        """
+        self._flights.pop(key, None)
+
+    def _land(self, key: T.Hashable, flight: asyncio.Future):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.cancelled():
+            # All callers may have been cancelled; don't warn about an
+            # exception that nobody retrieved:
+            flight.exception()
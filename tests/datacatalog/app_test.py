@@ -1,3 +1,5 @@
+import json
+import tempfile
 import time
 
 import jwt
@@ -7,6 +9,8 @@ from aiohttp import FormData
 from aiohttp.test_utils import unittest_run_loop
 from mockito import when, unstub, any
 
+from datacatalog import jwks
+from datacatalog.handlers import datasets
 from datacatalog.plugins import postgres as pgpl, swift
 from tests.datacatalog.base_test_case import BaseTestCase
 
@@ -51,6 +55,59 @@ class DatasetTestCase(BaseTestCase):
             self.assertEqual(response.status, 200)
             self.assertIn(expected_text, text)
 
+    @unittest_run_loop
+    async def test_openapi_conditional(self):
+        response = await self.client.request(
+            "GET", "/openapi", headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        etag = response.headers['ETag']
+        self.assertIn('"openapi": "3.0.0"', await response.text())
+
+        response = await self.client.request(
+            "GET", "/openapi", headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(response.status, 304)
+
+        # Another encoding is another representation:
+        response = await self.client.request(
+            "GET", "/openapi", headers={'Accept-Encoding': 'identity', 'If-None-Match': etag})
+        self.assertEqual(response.status, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    @unittest_run_loop
+    async def test_jwks_source(self):
+        keyset = self.app['jwks']
+        (kid, _), = keyset.signers.items()
+        rotated = json.loads(self.app.config['jwks'])
+        for key in rotated['keys']:
+            key['kid'] = 'rotated'
+        old_verifiers = keyset.verifiers
+        self.app['token_cache'].put(old_verifiers, 'token', {'CAT/R'}, 'test@test.nl', None)
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            f.write('{"keys": [')
+            f.flush()
+            source = jwks.KeySource(keyset, path=f.name)
+            try:
+                # A JWKSet that fails to load is loaded again on the next
+                # refresh, and the current keys are kept:
+                for _ in range(2):
+                    with self.assertRaises(jwks.JWKError):
+                        await source.refresh()
+                self.assertEqual(list(keyset.signers), [kid])
+                f.seek(0)
+                f.truncate()
+                json.dump(rotated, f)
+                f.flush()
+                self.assertTrue(await source.refresh())
+                self.assertEqual(list(keyset.signers), ['rotated'])
+                self.assertNotIn(kid, keyset.verifiers)
+                # Unchanged files aren't loaded again:
+                self.assertFalse(await source.refresh())
+                # Tokens verified with the old keys are forgotten:
+                self.assertIsNone(self.app['token_cache'].get(keyset.verifiers, 'token'))
+            finally:
+                keyset.replace(jwks.load(self.app.config['jwks']))
+
     @unittest_run_loop
     async def test_dataset_operations(self):
         with open(self._WORKING_PATH + path.sep + 'test.json') as definition:
@@ -187,6 +244,122 @@ class DatasetTestCase(BaseTestCase):
 
         self.assertEqual(response.status, 204, 'Redacteur mag ongepubliceerde dataset niet opslaan')
 
+    @unittest_run_loop
+    async def test_bulk_operations(self):
+        with open(self._WORKING_PATH + path.sep + 'test.json') as definition:
+            data = json.load(definition)
+
+        with open(self._WORKING_PATH + path.sep + 'test_update.json') as defn:
+            updated_data = json.load(defn)
+
+        headers = {
+            'content-type': 'application/x-ndjson',
+            'authorization': self.admin_token
+        }
+
+        response = await self.client.request(
+            "POST", "/datasets/_bulk", data=json.dumps({'doc': data}), headers={
+                **headers, 'content-type': 'application/json'
+            })
+        self.assertEqual(response.status, 415, 'Bulk accepteert geen json')
+
+        body = '\n'.join([
+            json.dumps({'doc': data}),
+            'invalid json',
+            '',
+            json.dumps({'id': 'unknown_dataset', 'ifMatch': '"random"', 'doc': updated_data}),
+            json.dumps({'doc': data}),
+        ]) + '\n'
+        response = await self.client.request(
+            "POST", "/datasets/_bulk", data=body, headers=headers)
+        self.assertEqual(response.status, 200, 'Bulk upload mislukt')
+        results = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual([r['line'] for r in results], [1, 2, 4, 5])
+        self.assertEqual([r['status'] for r in results], [201, 400, 412, 412])
+        self.assertEqual(results[0]['id'], _SUT_DOC_ID)
+        etag = results[0]['etag']
+
+        response = await self.client.request(
+            "GET", f"/datasets/{_SUT_DOC_ID}")
+        self.assertEqual(response.headers.get('Etag'), etag)
+
+        body = '\n'.join([
+            json.dumps({'id': _SUT_DOC_ID, 'ifMatch': '"random"', 'doc': updated_data}),
+            json.dumps({'id': _SUT_DOC_ID, 'ifMatch': [etag], 'doc': updated_data}),
+        ])
+        response = await self.client.request(
+            "POST", "/datasets/_bulk", data=body, headers=headers)
+        results = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual([r['status'] for r in results], [412, 204])
+
+        response = await self.client.request(
+            "GET", f"/datasets/{_SUT_DOC_ID}")
+        self.assertEqual(response.headers.get('Etag'), results[1]['etag'])
+        self.assertEqual((await response.json())['dct:description'], 'Een nieuw lijstje')
+
+        # Check redact access
+        response = await self.client.request(
+            "POST", "/datasets/_bulk", data=json.dumps({'doc': data}), headers={
+                **headers, 'authorization': self.redact_token
+            })
+        results = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual([r['status'] for r in results], [403])
+
+        # Lines that fail while they're prepared don't abort the response:
+        without_status = {k: v for k, v in data.items() if k != 'ams:status'}
+        body = '\n'.join([
+            json.dumps({'doc': without_status}),
+            json.dumps({'doc': dict(data, **{'@context': 'not a context'})}),
+            json.dumps({'doc': data}),
+        ])
+        response = await self.client.request(
+            "POST", "/datasets/_bulk", data=body, headers={
+                **headers, 'authorization': self.redact_token
+            })
+        self.assertEqual(response.status, 200)
+        results = [json.loads(line) for line in (await response.text()).splitlines()]
+        self.assertEqual([r['line'] for r in results], [1, 2, 3])
+        self.assertEqual(results[1]['status'], 400)
+        self.assertEqual(results[2]['status'], 403)
+
+    @unittest_run_loop
+    async def test_fields(self):
+        with open(self._WORKING_PATH + path.sep + 'test.json') as definition:
+            data = definition.read()
+        response = await self.client.request(
+            "POST", "/datasets", data=data, headers={
+                'content-type': 'application/json',
+                'authorization': self.admin_token
+            })
+        self.assertEqual(response.status, 201, 'Toevoegen dataset mislukt')
+
+        fields = 'dct:identifier,dct:title,dcat:distribution/dcat:mediaType'
+        for endpoint in ['/datasets', '/harvest']:
+            response = await self.client.request(
+                "GET", endpoint, params={'fields': fields})
+            self.assertEqual(response.status, 200)
+            dataset, = (await response.json())['dcat:dataset']
+            self.assertEqual(set(dataset), {'dct:identifier', 'dct:title', 'dcat:distribution'})
+            for distribution in dataset['dcat:distribution']:
+                self.assertLessEqual(set(distribution), {'dcat:mediaType'})
+
+            response = await self.client.request(
+                "GET", endpoint, params={'fields': 'dct:title,unknown'})
+            self.assertEqual(response.status, 400)
+
+    @unittest_run_loop
+    async def test_cursor(self):
+        response = await self.client.request("GET", "/datasets", params={'limit': '1'})
+        self.assertEqual(response.status, 200)
+        cursor = datasets._encode_cursor(('', 'a'))
+        response = await self.client.request(
+            "GET", "/datasets", params={'limit': '1', 'cursor': cursor})
+        self.assertEqual(response.status, 200)
+        # An offset and a cursor don't combine:
+        response = await self.client.request(
+            "GET", "/datasets", params={'limit': '1', 'cursor': cursor, 'offset': '1'})
+        self.assertEqual(response.status, 400)
+
     @unittest_run_loop
     async def testUpload(self):
         headers = {
@@ -1,10 +1,23 @@
+import asyncio
+import types
 import unittest
 import datetime
+from copy import deepcopy
+
+import jsonschema
+
+from datacatalog import dcat
 
 from datacatalog.plugins.dcat_ap_ams import (
     mds_before_storage,
     mds_after_storage,
-    mds_canonicalize
+    mds_after_storage_many,
+    mds_after_write,
+    mds_canonicalize,
+    mds_canonicalize_many,
+    mds_context,
+    mds_json_schema,
+    _is_compact
 )
 
 
@@ -139,7 +152,160 @@ class TestDcatd(unittest.TestCase):
         canonicalized = self._canonicalize(with_past_date)
         self.assertEqual(canonicalized["foaf:isPrimaryTopicOf"]['dct:modified'], this_date)
 
+    def test_is_compact(self):
+        ctx = mds_context()
+        data = {
+            "@id": "ams-dcatd:_FlXXpXDa-Ro3Q",
+            "dct:identifier": "_FlXXpXDa-Ro3Q",
+            "dct:title": "Ouderen",
+            "dcat:distribution": [{"dcat:mediaType": "text/html"}],
+            "dcat:keyword": ["dementie"]
+        }
+        compacted = mds_canonicalize(app={}, data=dict(data, **{'@context': ctx}))
+        self.assertTrue(_is_compact(compacted, ctx))
+        self.assertEqual(mds_canonicalize(app={}, data=compacted), compacted)
+
+        self.assertFalse(_is_compact(data, ctx))
+        self.assertFalse(_is_compact(
+            dict(compacted, **{'dcat:keyword': 'dementie'}), ctx
+        ))
+        self.assertFalse(_is_compact(
+            dict(compacted, **{'@id': 'http://localhost/datasets/_FlXXpXDa-Ro3Q'}), ctx
+        ))
+
+    def test_compiled_canonicalizer(self):
+        nested = dcat.Object().add('b', dcat.Integer())
+        obj = dcat.Object().add('a', dcat.List(nested)).add('d', dcat.Date())
+        self.assertEqual(
+            obj.canonicalize({'a': [{'b': 12}, {}, None], 'd': ' 2018-01-02T10:00:00 '}),
+            {'a': [{'b': 12}, {}], 'd': '2018-01-02'}
+        )
+        self.assertEqual(
+            obj.canonicalize({'a': [{'b': '12', 'c': ' x '}], 'x': 1}),
+            {'a': [{'b': 12}]}
+        )
+        # Adding a property to a nested object recompiles its ancestors:
+        nested.add('c', dcat.String())
+        self.assertEqual(
+            obj.canonicalize({'a': [{'b': '12', 'c': ' x '}]}),
+            {'a': [{'b': 12, 'c': 'x'}]}
+        )
+        with self.assertRaisesRegex(TypeError, "^1: not a string$"):
+            obj.canonicalize({'d': 1})
+        with self.assertRaisesRegex(ValueError, "^ 12 : not an integer$"):
+            obj.canonicalize({'a': [{'b': ' 12 '}]})
+        with self.assertRaisesRegex(TypeError, "^x: not a list$"):
+            obj.canonicalize({'a': 'x'})
+
+    def test_validate(self):
+        obj = dcat.Object().add('a', dcat.String())
+        self.assertIs(obj.validate({'a': 'x'}, 'PUT'), obj)
+        with self.assertRaises(jsonschema.ValidationError):
+            obj.validate({'a': ''}, 'PUT')
+        self.assertIs(obj.validator('PUT'), obj.validator('PUT'))
+        # Adding a property invalidates the cached validator:
+        obj.add('b', dcat.Integer(required=1))
+        with self.assertRaises(jsonschema.ValidationError):
+            obj.validate({'a': 'x'}, 'PUT')
+
+    def test_many(self):
+        docs = [
+            ('a', {'@id': 'ams-dcatd:a', 'dct:title': ' A ', '@context': mds_context()}),
+            ('b', {'@id': 'ams-dcatd:b', 'dcat:distribution': [{'dcat:accessURL': 'http://b/', 'dc:identifier': '1'}]})
+        ]
+        canonical_docs = mds_canonicalize_many(app={}, docs=docs)
+        self.assertEqual(canonical_docs, [mds_canonicalize(app={}, data=doc) for docid, doc in docs])
+        docs = list(zip(['a', 'b'], canonical_docs))
+        self.assertEqual(
+            mds_after_storage_many(app={}, docs=docs),
+            [mds_after_storage(app={}, data=doc, doc_id=docid) for docid, doc in docs]
+        )
+
+    def test_set_required_values(self):
+        nested = dcat.Object(required={}).add('b', dcat.String(required='x'))
+        obj = dcat.Object().add('a', nested).add('c', dcat.String(required='y'))
+        schema = deepcopy(obj.schema('GET'))
+        self.assertEqual(obj.set_required_values({}), {'a': {'b': 'x'}, 'c': 'y'})
+        value = {'a': {'d': 1}}
+        self.assertEqual(obj.set_required_values(value), {'a': {'b': 'x', 'd': 1}, 'c': 'y'})
+        self.assertEqual(value, {'a': {'d': 1}})
+        # The schema and its required values are left unchanged:
+        self.assertEqual(nested.required, {})
+        self.assertEqual(obj.schema('GET'), schema)
+        complete = {'a': {'b': 'z'}, 'c': 'w'}
+        self.assertIs(obj.set_required_values(complete), complete)
+
+    def test_transforms_copy_on_write(self):
+        old_data = mds_canonicalize(app={}, data={
+            '@id': 'ams-dcatd:a',
+            'dct:title': 'Old',
+            'foaf:isPrimaryTopicOf': {'dct:issued': '2006-12-13'},
+            'dcat:distribution': [{
+                'dcat:accessURL': 'http://a/', 'dc:identifier': '1',
+                'foaf:isPrimaryTopicOf': {'dct:issued': '2006-12-13'}
+            }]
+        })
+        data = mds_canonicalize(app={}, data={
+            '@id': 'ams-dcatd:a',
+            'dct:title': 'New',
+            'dct:identifier': 'a',
+            'ams:license': 'cc-by',
+            'dcat:distribution': [
+                {'dcat:accessURL': 'http://a/', 'dc:identifier': '1'},
+                {'dcat:accessURL': 'http://b/'}
+            ]
+        })
+        original_data, original_old_data = deepcopy(data), deepcopy(old_data)
+        stored = mds_before_storage(app={}, data=data, old_data=old_data)
+        self.assertEqual(data, original_data)
+        self.assertEqual(old_data, original_old_data)
+        self.assertNotIn('dct:identifier', stored)
+        self.assertEqual([d['dc:identifier'] for d in stored['dcat:distribution']], ['1', '2'])
+
+        original_stored = deepcopy(stored)
+        rendered = mds_after_storage(app={}, data=stored, doc_id='a')
+        self.assertEqual(stored, original_stored)
+        self.assertEqual(rendered['dct:identifier'], 'a')
+        self.assertEqual(rendered['dcat:distribution'][0]['dct:license'], 'cc-by')
+        self.assertEqual(mds_after_storage_many(app={}, docs=[('a', stored)]), [rendered])
+        self.assertEqual(stored, original_stored)
+
+    def test_canonicalize_projection(self):
+        nested = dcat.Object().add('b', dcat.Integer()).add('c', dcat.String())
+        obj = dcat.Object().add('a', dcat.List(nested)).add('d', dcat.Date())
+        value = {'a': [{'b': '12', 'c': ' x '}], 'd': 1}
+        self.assertEqual(obj.canonicalize(value, {'a': {'c': None}}), {'a': [{'c': 'x'}]})
+        self.assertEqual(obj.canonicalize(value, {'a': None}), {'a': [{'b': 12, 'c': 'x'}]})
+        with self.assertRaises(TypeError):
+            obj.canonicalize(value)
+
+    def test_json_schema_cache(self):
+        extracted = []
+
+        async def storage_extract(app, ptr, distinct):
+            extracted.append(ptr)
 
+            async def values():
+                yield 'value'
+            return values()
 
+        app = types.SimpleNamespace(hooks=types.SimpleNamespace(storage_extract=storage_extract))
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
 
+        def json_schema():
+            return loop.run_until_complete(mds_json_schema(app=app, method='PUT'))
 
+        mds_after_write(app=app, docids=[])
+        schema = json_schema()
+        self.assertEqual(schema['properties']['ams:owner']['examples'], ['value'])
+        self.assertEqual(len(extracted), 2)
+        self.assertIs(json_schema(), schema)
+        # Transforming a document before it is stored doesn't invalidate the
+        # examples; the write may still fail:
+        mds_before_storage(app=app, data={'dct:title': 'title'})
+        self.assertIs(json_schema(), schema)
+        self.assertEqual(len(extracted), 2)
+        mds_after_write(app=app, docids=['deleted'])
+        self.assertIsNot(json_schema(), schema)
+        self.assertEqual(len(extracted), 4)
@@ -7,9 +7,10 @@ import os
 from os import path
 
 import aiopluggy
+import jsonpointer
 import pytest
 
-from datacatalog import config, plugin_interfaces
+from datacatalog import config, get_invalid_links, plugin_interfaces
 from datacatalog.plugins import postgres as postgres_plugin
 
 # set the config file location
@@ -171,6 +172,93 @@ def test_storage_extract(event_loop, corpus, app):
     assert len(empty) == 0
 
 
+def test_storage_extract_materialized(event_loop, app):
+    etag = event_loop.run_until_complete(postgres_plugin.storage_create(
+        app, 'keyword_dataset', doc={'id': 'keyword_dataset', 'dcat:keyword': ['b', 'a', 'b']},
+        searchable_text={'A': '', 'B': '', 'C': '', 'D': ''}, iso_639_1_code=None
+    ))
+    try:
+        async def distinct_keywords():
+            return [keyword async for keyword in postgres_plugin.storage_extract(
+                app=app, ptr='/properties/dcat:keyword/items', distinct=True)]
+
+        assert event_loop.run_until_complete(distinct_keywords()) == ['a', 'b']
+    finally:
+        event_loop.run_until_complete(postgres_plugin.storage_delete(
+            app=app, docid='keyword_dataset', etags={etag}))
+
+
+def test_rebuild_facets(event_loop, app):
+    async def stale_row():
+        return await app['pool'].fetchval(
+            'SELECT count FROM dataset_facets WHERE facet_ptr=$1', '/properties/stale')
+
+    event_loop.run_until_complete(app['pool'].execute(
+        "INSERT INTO dataset_facets (facet_ptr, value, status, lang, count) "
+        "VALUES ('/properties/stale', '', '', '', 1)"))
+    try:
+        # The table was filled with these facets at startup:
+        event_loop.run_until_complete(postgres_plugin._rebuild_facets(app))
+        assert event_loop.run_until_complete(stale_row()) == 1
+        # Other facets (or paths) refill it:
+        other_app = {'pool': app['pool'], 'materialized_facets': app['materialized_facets'][:2]}
+        event_loop.run_until_complete(postgres_plugin._rebuild_facets(other_app))
+        assert event_loop.run_until_complete(stale_row()) is None
+    finally:
+        event_loop.run_until_complete(app['pool'].execute(
+            "DELETE FROM dataset_facets WHERE facet_ptr='/properties/stale'"))
+        event_loop.run_until_complete(postgres_plugin._rebuild_facets(app))
+
+
+def test_out_of_band_writes_keep_facet_counts(event_loop, app):
+    doc = {'id': 'keyword_dataset', 'dcat:keyword': ['c'], 'ams:status': 'beschikbaar'}
+    etag = event_loop.run_until_complete(postgres_plugin.storage_create(
+        app, 'keyword_dataset', doc=doc,
+        searchable_text={'A': '', 'B': '', 'C': '', 'D': ''}, iso_639_1_code=None
+    ))
+
+    async def keyword_counts():
+        return {
+            (row['value'], row['status']): row['count'] for row in await app['pool'].fetch(
+                'SELECT value, status, count FROM dataset_facets WHERE facet_ptr=$1',
+                '/properties/dcat:keyword/items')
+        }
+
+    async def store_rendition():
+        stored_etag = await app['pool'].fetchval('SELECT etag FROM dataset WHERE id=$1', docid)
+        assert await postgres_plugin.storage_store_rendition(
+            app=app, docid=docid, etag=stored_etag, version='v1',
+            rendition={'rendered': True}, summary={})
+
+    async def rendition_columns():
+        return tuple(await app['pool'].fetchrow(
+            'SELECT rendered, rendered_summary, render_version, rendered_etag FROM dataset WHERE id=$1',
+            docid))
+
+    docid = 'keyword_dataset'
+    try:
+        assert event_loop.run_until_complete(keyword_counts()) == {('c', 'beschikbaar'): 1}
+        event_loop.run_until_complete(store_rendition())
+        event_loop.run_until_complete(postgres_plugin.set_new_identifier(
+            app=app, old_id=docid, new_id='renamed_dataset'))
+        docid = 'renamed_dataset'
+        assert event_loop.run_until_complete(keyword_counts()) == {('c', 'beschikbaar'): 1}
+        assert event_loop.run_until_complete(rendition_columns()) == (None,) * 4
+        event_loop.run_until_complete(store_rendition())
+
+        async def make_unavailable():
+            async with app['pool'].acquire() as con:
+                return await get_invalid_links.update_doc(
+                    con, docid, dict(doc, **{'ams:status': 'niet_beschikbaar'}))
+
+        etag = event_loop.run_until_complete(make_unavailable())
+        assert event_loop.run_until_complete(keyword_counts()) == {('c', 'niet_beschikbaar'): 1}
+        assert event_loop.run_until_complete(rendition_columns()) == (None,) * 4
+    finally:
+        event_loop.run_until_complete(postgres_plugin.storage_delete(
+            app=app, docid=docid, etags={etag}))
+
+
 def test_search_search(event_loop, corpus, app):
     # search on query
     async def search(record):
@@ -217,6 +305,265 @@ def test_search_search(event_loop, corpus, app):
     assert results[0][0] == 'dutch_dataset1'
 
 
+def test_search_search_facets_missing_keys(event_loop, app):
+    doc = {
+        'id': 'mixed_dataset',
+        'ams:status': 'beschikbaar',
+        'dcat:keyword': 'not a list',
+        'dcat:distribution': [
+            {'dcat:mediaType': 'text/csv'},
+            {'dcat:mediaType': 'application/json', 'ams:serviceType': 'wms'},
+            'not an object',
+            {'ams:serviceType': 'wfs'},
+        ]
+    }
+    facets = [
+        '/properties/dcat:distribution/items/properties/ams:serviceType',
+        '/properties/dcat:distribution/items/properties/dcat:mediaType',
+        '/properties/dcat:keyword/items'
+    ]
+    expected = {'/': 1}
+    for facet in facets:
+        counts = expected[facet] = {}
+        for value in postgres_plugin._extract_values(doc, jsonpointer.JsonPointer(facet).parts):
+            counts[str(value)] = counts.get(str(value), 0) + 1
+    assert expected[facets[0]] == {'wms': 1, 'wfs': 1}
+    # Facets without values are in the result info too:
+    assert expected[facets[2]] == {}
+    etag = event_loop.run_until_complete(postgres_plugin.storage_create(
+        app, 'mixed_dataset', doc=doc,
+        searchable_text={'A': '', 'B': '', 'C': '', 'D': ''}, iso_639_1_code=None
+    ))
+
+    async def search(filters):
+        result_info = {}
+        async for r in postgres_plugin.search_search(
+                app=app, q='', sortpath=['id'], result_info=result_info,
+                facets=facets, filters=filters):
+            pass
+        return result_info
+
+    try:
+        # From the facet count table, and counted in the query:
+        assert event_loop.run_until_complete(search(None)) == expected
+        assert event_loop.run_until_complete(
+            search({'/properties/id': {'eq': 'mixed_dataset'}})) == expected
+    finally:
+        event_loop.run_until_complete(postgres_plugin.storage_delete(
+            app=app, docid='mixed_dataset', etags={etag}))
+
+
+def test_search_search_filter_columns(event_loop, app):
+    docs = {
+        'status_dataset1': {'ams:status': 'beschikbaar', 'ams:owner': 'Amsterdam'},
+        'status_dataset2': {'ams:status': 'niet_beschikbaar', 'ams:owner': 'Amsterdam'},
+        'status_dataset3': {'ams:status': 'beschikbaar', 'ams:owner': 'Other'},
+    }
+    etags = {
+        docid: event_loop.run_until_complete(postgres_plugin.storage_create(
+            app, docid, doc=doc, searchable_text={'A': docid}, iso_639_1_code='nl'))
+        for docid, doc in docs.items()
+    }
+
+    async def search(filters):
+        return {r[0] async for r in postgres_plugin.search_search(
+            app=app, q='', sortpath=['ams:sort_modified'], result_info={},
+            filters=filters)}
+
+    try:
+        assert event_loop.run_until_complete(search({
+            '/properties/ams:status': {'eq': 'beschikbaar'}
+        })) == {'status_dataset1', 'status_dataset3'}
+        assert event_loop.run_until_complete(search({
+            '/properties/ams:status': {'in': ['beschikbaar', 'niet_beschikbaar']},
+            '/properties/ams:owner': {'eq': 'Amsterdam'}
+        })) == {'status_dataset1', 'status_dataset2'}
+        assert event_loop.run_until_complete(search({
+            '/properties/ams:owner': {'in': []}
+        })) == set()
+        assert event_loop.run_until_complete(search({
+            '/properties/dcat:keyword/items': {'in': []}
+        })) == set()
+    finally:
+        for docid, etag in etags.items():
+            event_loop.run_until_complete(
+                postgres_plugin.storage_delete(app=app, docid=docid, etags={etag}))
+
+
+def test_migrate(event_loop, app):
+    async def migrate():
+        async with app['pool'].acquire() as con:
+            transaction = con.transaction()
+            await transaction.start()
+            try:
+                # A table as created by versions without generated columns:
+                await con.execute('CREATE SCHEMA "migrate_test"')
+                await con.execute('SET LOCAL search_path TO "migrate_test"')
+                await con.execute('''
+                    CREATE TABLE "dataset" (
+                        "id" character varying(254) PRIMARY KEY,
+                        "doc" jsonb NOT NULL,
+                        "etag" character varying(254) NOT NULL,
+                        "searchable_text" tsvector,
+                        "lang" character varying(20),
+                        "summary" jsonb
+                    )''')
+                await con.execute(
+                    'INSERT INTO "dataset" (id, doc, etag) VALUES ($1, $2, $3)',
+                    'old_dataset', {'ams:status': 'beschikbaar', 'ams:owner': 'Amsterdam'}, '"1"')
+                await con.execute(postgres_plugin._Q_MIGRATE)
+                # The migration is idempotent:
+                await con.execute(postgres_plugin._Q_MIGRATE)
+                return dict(await con.fetchrow('SELECT * FROM "dataset"'))
+            finally:
+                await transaction.rollback()
+
+    row = event_loop.run_until_complete(migrate())
+    assert row['rendered_etag'] is None
+    assert row['sort_modified'] == ''
+    assert row['status'] == 'beschikbaar'
+    assert row['owner'] == 'Amsterdam'
+    assert row['rendered'] is None and row['render_version'] is None
+    assert 'summary' not in row
+
+
+def test_search_search_paging(event_loop, corpus, app):
+    async def search(limit, offset):
+        result_info = {}
+        return [r async for r in postgres_plugin.search_search(
+            app=app, q='', sortpath=['id'], result_info=result_info,
+            limit=limit, offset=offset, filters=None)], result_info
+
+    all_results, result_info = event_loop.run_until_complete(search(None, 0))
+    assert result_info['/'] == len(corpus)
+    assert len(all_results) == len(corpus)
+
+    page, result_info = event_loop.run_until_complete(search(2, 1))
+    assert result_info['/'] == len(corpus)
+    assert page == all_results[1:3]
+
+    page, result_info = event_loop.run_until_complete(search(2, len(corpus)))
+    assert result_info['/'] == len(corpus)
+    assert page == []
+
+
+def test_search_search_keyset_paging(event_loop, corpus, app):
+    async def search(limit, after, sortpath=('id',)):
+        return [r async for r in postgres_plugin.search_search(
+            app=app, q='', sortpath=list(sortpath), result_info={},
+            limit=limit, after=after, filters=None, sort_key=True)]
+
+    all_results = event_loop.run_until_complete(search(None, None))
+    docid, doc, sort_key = all_results[1]
+    assert sort_key == doc['id']
+    page = event_loop.run_until_complete(search(2, (sort_key, docid)))
+    assert page == all_results[2:4]
+
+    # None of the documents has a sort value, so they sort as the empty
+    # string, by id:
+    all_results = event_loop.run_until_complete(search(None, None, ['ams:sort_modified']))
+    assert {sort_key for docid, doc, sort_key in all_results} == {''}
+    assert [docid for docid, doc, sort_key in all_results] == sorted(corpus, reverse=True)
+    page = event_loop.run_until_complete(
+        search(2, ('', all_results[0][0]), ['ams:sort_modified']))
+    assert page == all_results[1:3]
+
+
+def test_storage_etag(event_loop, corpus, app):
+    assert event_loop.run_until_complete(
+        postgres_plugin.storage_etag(app=app, docid='dutch_dataset1')
+    ) == corpus['dutch_dataset1']['etag']
+    with pytest.raises(KeyError):
+        event_loop.run_until_complete(
+            postgres_plugin.storage_etag(app=app, docid='nonexistent'))
+
+
+def test_storage_rendition(event_loop, corpus, app):
+    record = corpus['dutch_dataset1']
+    rendition, etag = event_loop.run_until_complete(
+        postgres_plugin.storage_retrieve_rendition(
+            app=app, docid='dutch_dataset1', version='v1'))
+    assert rendition is None
+    assert etag == record['etag']
+    assert not event_loop.run_until_complete(
+        postgres_plugin.storage_store_rendition(
+            app=app, docid='dutch_dataset1', etag='"old"', version='v1',
+            rendition={'rendered': True}, summary={}))
+    assert event_loop.run_until_complete(
+        postgres_plugin.storage_store_rendition(
+            app=app, docid='dutch_dataset1', etag=etag, version='v1',
+            rendition={'rendered': True}, summary={}))
+    rendition, etag = event_loop.run_until_complete(
+        postgres_plugin.storage_retrieve_rendition(
+            app=app, docid='dutch_dataset1', version='v1'))
+    assert rendition == {'rendered': True}
+    rendition, etag = event_loop.run_until_complete(
+        postgres_plugin.storage_retrieve_rendition(
+            app=app, docid='dutch_dataset1', version='v2'))
+    assert rendition is None
+
+    async def search(fields):
+        return {docid: (doc, rendition) async for docid, doc, rendition in postgres_plugin.search_search(
+            app=app, q='', sortpath=['id'], result_info={}, iso_639_1_code='nl',
+            render_version='v1', fields=fields)}
+    results = event_loop.run_until_complete(search(None))
+    assert results['dutch_dataset1'] == (None, {'rendered': True})
+    assert results['dutch_dataset2'][1] is None
+    results = event_loop.run_until_complete(search(['other']))
+    assert results['dutch_dataset1'] == (None, {})
+    assert results['dutch_dataset2'][0] == corpus['dutch_dataset2']['doc']
+
+    async def stale(version):
+        return {docid async for docid, etag, doc in postgres_plugin.storage_stale_renditions(
+            app=app, version=version)}
+    assert 'dutch_dataset1' not in event_loop.run_until_complete(stale('v1'))
+    assert 'dutch_dataset2' in event_loop.run_until_complete(stale('v1'))
+
+    # A rendition of another version of the document isn't current, even if
+    # the writer didn't remove it:
+    etag = record['etag'] = '"out_of_band"'
+    event_loop.run_until_complete(app['pool'].execute(
+        'UPDATE dataset SET etag=$1 WHERE id=$2', etag, 'dutch_dataset1'))
+    rendition, _ = event_loop.run_until_complete(
+        postgres_plugin.storage_retrieve_rendition(
+            app=app, docid='dutch_dataset1', version='v1'))
+    assert rendition is None
+    results = event_loop.run_until_complete(search(None))
+    assert results['dutch_dataset1'][1] is None
+    assert 'dutch_dataset1' in event_loop.run_until_complete(stale('v1'))
+    assert event_loop.run_until_complete(
+        postgres_plugin.storage_store_rendition(
+            app=app, docid='dutch_dataset1', etag=etag, version='v1',
+            rendition={'rendered': True}, summary={}))
+
+    # Updating the document removes its rendition
+    record['etag'] = event_loop.run_until_complete(
+        postgres_plugin.storage_update(
+            app=app, docid='dutch_dataset1', doc={'id': 'dutch_dataset1'},
+            searchable_text=record['searchable_text'], etags={etag},
+            iso_639_1_code='nl'))
+    rendition, etag = event_loop.run_until_complete(
+        postgres_plugin.storage_retrieve_rendition(
+            app=app, docid='dutch_dataset1', version='v1'))
+    assert rendition is None
+
+
+def test_storage_many_renditions(event_loop, corpus, app):
+    docs = event_loop.run_until_complete(postgres_plugin.storage_retrieve_many(
+        app=app, docids=['dutch_dataset1', 'dutch_dataset2', 'nonexistent']))
+    assert set(docs) == {'dutch_dataset1', 'dutch_dataset2'}
+    assert docs['dutch_dataset1'] == (corpus['dutch_dataset1']['doc'], corpus['dutch_dataset1']['etag'])
+    assert event_loop.run_until_complete(postgres_plugin.storage_store_rendition_many(
+        app=app, version='v1', renditions=[
+            ('dutch_dataset1', corpus['dutch_dataset1']['etag'], {'rendered': 1}, {}),
+            ('dutch_dataset2', '"old"', {'rendered': 2}, {}),
+        ])) == [True, False]
+    for docid, expected in [('dutch_dataset1', {'rendered': 1}), ('dutch_dataset2', None)]:
+        rendition, etag = event_loop.run_until_complete(
+            postgres_plugin.storage_retrieve_rendition(app=app, docid=docid, version='v1'))
+        assert rendition == expected
+
+
 def test_storage_delete(event_loop, corpus, app):
     for doc_id, record in corpus.items():
         event_loop.run_until_complete(
@@ -225,7 +572,108 @@ def test_storage_delete(event_loop, corpus, app):
         )
 
 
+def test_storage_create_update_many(event_loop, corpus, app):
+    new_docs = [
+        ('bulk_dataset1', {'id': 'bulk_dataset1'}, {'A': 'Bulk 1'}, 'nl'),
+        ('dutch_dataset1', {'id': 'dutch_dataset1'}, {'A': 'Bulk'}, 'nl'),
+        ('bulk_dataset2', {'id': 'bulk_dataset2'}, {'A': 'Bulk 2'}, None),
+        ('bulk_dataset1', {'id': 'bulk_dataset1'}, {'A': 'Bulk 1'}, 'nl'),
+    ]
+    results = event_loop.run_until_complete(
+        postgres_plugin.storage_create_many(app=app, docs=new_docs))
+    assert isinstance(results[0], str)
+    assert isinstance(results[1], KeyError)
+    assert isinstance(results[2], str)
+    assert isinstance(results[3], KeyError)
+    etags = {'bulk_dataset1': results[0], 'bulk_dataset2': results[2]}
+    try:
+        results = event_loop.run_until_complete(
+            postgres_plugin.storage_update_many(app=app, docs=[
+                ('bulk_dataset1', {'id': 'bulk_dataset1', 'x': 1}, {}, {etags['bulk_dataset1']}, 'nl'),
+                ('bulk_dataset2', {'id': 'bulk_dataset2', 'x': 1}, {}, {'"wrong"'}, 'nl'),
+                ('bulk_dataset3', {'id': 'bulk_dataset3'}, {}, {'"wrong"'}, 'nl'),
+            ]))
+        assert isinstance(results[0], str)
+        assert isinstance(results[1], ValueError)
+        assert isinstance(results[2], KeyError)
+        etags['bulk_dataset1'] = results[0]
+        doc, etag = event_loop.run_until_complete(
+            postgres_plugin.storage_retrieve(app=app, docid='bulk_dataset1', etags=None))
+        assert doc == {'id': 'bulk_dataset1', 'x': 1}
+        assert etag == results[0]
+    finally:
+        for doc_id, etag in etags.items():
+            event_loop.run_until_complete(
+                postgres_plugin.storage_delete(app=app, docid=doc_id, etags={etag}))
+
+
 def test_to_pg_json_query():
     assert postgres_plugin._to_pg_json_query("Veer 1") == "Veer:* & 1:*"
     assert postgres_plugin._to_pg_json_query_fullmatch("s") == "s"
     assert postgres_plugin._to_pg_json_query("s-Gravelandse Veer 1") == "s-Gravelandse:* & Veer:* & 1:*"
+
+
+def test_to_pg_jsonpath():
+    assert postgres_plugin._to_pg_jsonpath(['properties', 'ams:owner']) == \
+        'strict $ ? (exists(@."ams:owner"))."ams:owner"'
+    assert postgres_plugin._to_pg_jsonpath(
+        ['properties', 'dcat:distribution', 'items', 'properties', 'dcat:mediaType']
+    ) == 'strict $ ? (exists(@."dcat:distribution"))."dcat:distribution" ? (@.type() == "array")[*]' \
+         ' ? (exists(@."dcat:mediaType"))."dcat:mediaType"'
+    with pytest.raises(ValueError):
+        postgres_plugin._to_pg_jsonpath(['properties'])
+    with pytest.raises(ValueError):
+        postgres_plugin._to_pg_jsonpath(['foo'])
+
+
+def test_to_pg_json_filterexpression():
+    args = ['nl']
+    expr = postgres_plugin._to_pg_json_filterexpression({
+        '/properties/ams:status': {'in': ["beschikbaar", "o'neill"]},
+        '/properties/dcat:theme/items': {'eq': 'theme:energie'},
+        '/properties/dcat:keyword/items': {'in': ['a', 'b']},
+    }, args)
+    assert expr == (
+        ' AND status = ANY($2::text[])'
+        ' AND doc @> $3::jsonb'
+        ' AND (doc @> $4::jsonb OR doc @> $5::jsonb)'
+    )
+    assert args == [
+        'nl', ["beschikbaar", "o'neill"], '{"dcat:theme": ["theme:energie"]}',
+        '{"dcat:keyword": ["a"]}', '{"dcat:keyword": ["b"]}'
+    ]
+    args = []
+    assert postgres_plugin._to_pg_json_filterexpression(
+        {'/properties/dct:title': {'in': []}}, args) == ' AND (FALSE)'
+    assert args == []
+    with pytest.raises(ValueError):
+        postgres_plugin._to_pg_json_filterexpression(
+            {'/properties': {'eq': 'x'}}, [])
+
+
+def test_jsonb_codec():
+    codec = postgres_plugin._jsonb_codec('json', 'text')
+    assert codec['format'] == 'text'
+    assert codec['encoder']('{"a": 1}') == '{"a": 1}'
+    assert codec['encoder']({'a': 'é'}) == '{"a": "é"}'
+    assert codec['decoder']('{"a": [1, "é"]}') == {'a': [1, 'é']}
+    codec = postgres_plugin._jsonb_codec('json', 'binary')
+    assert codec['format'] == 'binary'
+    assert codec['encoder']('{"a": 1}') == b'\x01{"a": 1}'
+    assert codec['decoder'](codec['encoder']({'a': 'é'})) == {'a': 'é'}
+    with pytest.raises(ValueError):
+        codec['decoder'](b'\x02{}')
+
+
+def test_materialized_status_filter():
+    app = {'materialized_facets': [('/', 'strict $'), ('/properties/ams:owner', 'strict $."ams:owner"')]}
+    facets = [('/properties/ams:owner', None)]
+    status_filter = {'/properties/ams:status': {'in': ['beschikbaar', 'in_onderzoek']}}
+    assert postgres_plugin._materialized_status_filter(app, '', facets, None) == (True, None)
+    materialized, statuses = postgres_plugin._materialized_status_filter(app, '', facets, status_filter)
+    assert materialized and set(statuses) == {'beschikbaar', 'in_onderzoek'}
+    assert not postgres_plugin._materialized_status_filter(app, 'query', facets, None)[0]
+    assert not postgres_plugin._materialized_status_filter(
+        app, '', facets + [('/properties/dcat:keyword/items', None)], None)[0]
+    assert not postgres_plugin._materialized_status_filter(
+        app, '', facets, {'/properties/ams:owner': {'eq': 'Amsterdam'}})[0]
@@ -0,0 +1,94 @@
+import time
+import unittest
+
+from datacatalog import authorization
+
+
+class TestPathMatcher(unittest.TestCase):
+
+    def test_match(self):
+        paths = {
+            '/datasets': {'get': 'list'},
+            '/datasets/{dataset}': {'get': 'dataset', 'put': 'store'},
+            '/datasets/{dataset}/purls/{distribution}': {'get': 'purl'},
+        }
+        matcher = authorization.PathMatcher(paths)
+        self.assertEqual(matcher.match('/datasets', 'get'), ('/datasets', 'list'))
+        self.assertEqual(
+            matcher.match('/datasets/a', 'put'), ('/datasets/{dataset}', 'store'))
+        self.assertEqual(
+            matcher.match('/datasets/a/purls/1', 'get'),
+            ('/datasets/{dataset}/purls/{distribution}', 'purl'))
+        # Without a method, or with an unknown one, the path spec is returned:
+        self.assertEqual(
+            matcher.match('/datasets/a'), ('/datasets/{dataset}', paths['/datasets/{dataset}']))
+        self.assertEqual(
+            matcher.match('/datasets/a', 'delete'),
+            ('/datasets/{dataset}', paths['/datasets/{dataset}']))
+        self.assertEqual(matcher.match('/datasets/a/b', 'get'), (None, None))
+
+    def test_overlapping_templates(self):
+        # If several templates match a path, the last one in the definition
+        # wins, whichever is more specific:
+        paths = {
+            '/datasets/{dataset}': {'get': 'dataset'},
+            '/{collection}/{item}': {'get': 'item'},
+            '/datasets/{dataset}/purls/{distribution}': {'get': 'purl'},
+            '/datasets/{dataset}/{property}/{value}': {'get': 'value'},
+        }
+        matcher = authorization.PathMatcher(paths)
+        self.assertEqual(matcher.match('/datasets/a', 'get'), ('/{collection}/{item}', 'item'))
+        self.assertEqual(
+            matcher.match('/datasets/a/purls/1', 'get'),
+            ('/datasets/{dataset}/{property}/{value}', 'value'))
+
+        matcher = authorization.PathMatcher(dict(reversed(list(paths.items()))))
+        self.assertEqual(matcher.match('/datasets/a', 'get'), ('/datasets/{dataset}', 'dataset'))
+        self.assertEqual(
+            matcher.match('/datasets/a/purls/1', 'get'),
+            ('/datasets/{dataset}/purls/{distribution}', 'purl'))
+        # A path that is in the definition literally is matched exactly:
+        self.assertEqual(
+            authorization.PathMatcher(dict(paths, **{'/datasets/a': {'get': 'a'}})).match(
+                '/datasets/a', 'get'),
+            ('/datasets/a', 'a'))
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def test_expiry(self):
+        cache = authorization.TokenCache()
+        verifiers = {}
+        now = time.time()
+        cache.put(verifiers, 'valid', ['CAT/R'], 'subject', now + 60)
+        cache.put(verifiers, 'expired', ['CAT/R'], 'subject', now)
+        cache.put(verifiers, 'no_exp', ['CAT/W'], 'subject', None)
+        self.assertEqual(cache.get(verifiers, 'valid'), (frozenset({'CAT/R'}), 'subject', now + 60))
+        # A token expires at its exp:
+        self.assertIsNone(cache.get(verifiers, 'expired'))
+        self.assertNotIn('expired', cache._tokens)
+        self.assertEqual(cache.get(verifiers, 'no_exp')[0], frozenset({'CAT/W'}))
+        self.assertIsNone(cache.get(verifiers, 'unknown'))
+
+    def test_lru(self):
+        cache = authorization.TokenCache(maxsize=2)
+        verifiers = {}
+        cache.put(verifiers, 'a', [], 'a', None)
+        cache.put(verifiers, 'b', [], 'b', None)
+        self.assertIsNotNone(cache.get(verifiers, 'a'))
+        # 'b' is the least recently used:
+        cache.put(verifiers, 'c', [], 'c', None)
+        self.assertIsNone(cache.get(verifiers, 'b'))
+        self.assertIsNotNone(cache.get(verifiers, 'a'))
+        self.assertIsNotNone(cache.get(verifiers, 'c'))
+        self.assertEqual(len(cache._tokens), 2)
+
+    def test_verifiers_change(self):
+        cache = authorization.TokenCache()
+        verifiers = {'kid': 'key'}
+        cache.put(verifiers, 'a', ['CAT/R'], 'a', None)
+        self.assertIsNotNone(cache.get(verifiers, 'a'))
+        # A new set of keys flushes the cache, even if it has the same keys;
+        # then the token is verified again:
+        self.assertIsNone(cache.get(dict(verifiers), 'a'))
+        self.assertIsNone(cache.get(verifiers, 'a'))
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import types
+import unittest
+from unittest import mock
+
+from datacatalog import rendering
+
+
+class _App(dict):
+    pass
+
+
+class TestBodyCache(unittest.TestCase):
+
+    def test_lru(self):
+        doc = {'ams:status': 'beschikbaar', 'dct:title': 'x' * 10}
+        size = len(json.dumps(doc).encode())
+        cache = rendering.BodyCache(maxbytes=2 * size)
+        cached = cache.put('a', '"1"', 'v1', doc)
+        self.assertEqual(json.loads(cached.body.decode()), doc)
+        self.assertEqual(cached.status, 'beschikbaar')
+        cache.put('b', '"1"', 'v1', doc)
+        self.assertIs(cache.get('a', 'v1'), cached)
+        # 'b' is the least recently used:
+        cache.put('c', '"1"', 'v1', doc)
+        self.assertIsNone(cache.get('b', 'v1'))
+        self.assertEqual(cache.size, 2 * size)
+        # Replacing an entry doesn't count it twice:
+        cache.put('c', '"2"', 'v1', doc)
+        self.assertEqual(cache.get('c', 'v1').etag, '"2"')
+        self.assertEqual(cache.size, 2 * size)
+        cache.discard('c')
+        self.assertEqual(cache.size, size)
+
+    def test_version_mismatch(self):
+        doc = {'dct:title': 'x'}
+        size = len(json.dumps(doc).encode())
+        cache = rendering.BodyCache(maxbytes=2 * size)
+        cache.put('a', '"1"', 'v1', doc)
+        cache.put('b', '"1"', 'v1', doc)
+        # Another version of the rendering isn't returned, and is discarded:
+        self.assertIsNone(cache.get('a', 'v2'))
+        self.assertEqual(cache.size, size)
+        self.assertIsNone(cache.get('a', 'v1'))
+        self.assertIsNotNone(cache.get('b', 'v1'))
+
+    def test_too_large(self):
+        cache = rendering.BodyCache(maxbytes=10)
+        cached = cache.put('a', '"1"', 'v1', {'dct:title': 'x' * 10})
+        self.assertIn(b'xxxxxxxxxx', cached.body)
+        self.assertIsNone(cache.get('a', 'v1'))
+        self.assertEqual(cache.size, 0)
+
+
+class TestVersion(unittest.TestCase):
+
+    def setUp(self):
+        self.schema = {'type': 'object', 'properties': {'dct:title': {'type': 'string'}}}
+
+        async def mds_context():
+            return {'dct': 'http://purl.org/dc/terms/'}
+
+        async def mds_json_schema(app, method):
+            return self.schema
+
+        self.app = types.SimpleNamespace(
+            hooks=types.SimpleNamespace(mds_context=mds_context, mds_json_schema=mds_json_schema),
+            config={'web': {'baseurl': 'http://localhost/'}}
+        )
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def version(self):
+        return self.loop.run_until_complete(rendering.version(self.app))
+
+    def test_version(self):
+        version = self.version()
+        self.assertEqual(self.version(), version)
+        # A change of the schema makes all renditions stale:
+        self.schema = dict(self.schema, required=['dct:title'])
+        schema_version = self.version()
+        self.assertNotEqual(schema_version, version)
+        # So does a change of the code:
+        with mock.patch.object(rendering, 'RENDERING_VERSION', rendering.RENDERING_VERSION + 1):
+            self.assertNotEqual(self.version(), schema_version)
+        self.app.config['web']['baseurl'] = 'http://example.com/'
+        self.assertNotEqual(self.version(), schema_version)
+
+
+class TestRerenderStale(unittest.TestCase):
+
+    def test_batches(self):
+        stored = []
+
+        async def storage_stale_renditions(app, version):
+            async def stale():
+                for i in range(rendering.BATCH_SIZE + 1):
+                    yield str(i), '"1"', {'dct:title': str(i)}
+            return stale()
+
+        async def mds_canonicalize_many(app, docs, fields):
+            return [doc for docid, doc in docs]
+
+        async def mds_after_storage_many(app, docs):
+            return [dict(doc, **{'dct:identifier': docid}) for docid, doc in docs]
+
+        async def storage_store_rendition_many(app, version, renditions):
+            stored.append(renditions)
+            return [True] * len(renditions)
+
+        app = _App(render_version='v1')
+        app.hooks = types.SimpleNamespace(
+            storage_stale_renditions=storage_stale_renditions,
+            mds_canonicalize_many=mds_canonicalize_many,
+            mds_after_storage_many=mds_after_storage_many,
+            storage_store_rendition_many=storage_store_rendition_many
+        )
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        loop.run_until_complete(rendering.rerender_stale(app))
+        self.assertEqual([len(renditions) for renditions in stored], [rendering.BATCH_SIZE, 1])
+        docid, etag, rendition, summary = stored[1][0]
+        self.assertEqual(rendition, {'dct:title': docid, 'dct:identifier': docid})
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+
+from datacatalog import singleflight
+
+
+class TestGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.group = singleflight.Group()
+        self.calls = 0
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def compute(self, value, release):
+        self.calls += 1
+        await release.wait()
+        if isinstance(value, Exception):
+            raise value
+        return value
+
+    def test_do(self):
+        async def run():
+            release = asyncio.Event()
+            waiters = [
+                asyncio.ensure_future(self.group.do('a', self.compute, 1, release))
+                for _ in range(10)
+            ]
+            other = asyncio.ensure_future(self.group.do('b', self.compute, 2, release))
+            await asyncio.sleep(0)
+            self.assertEqual(len(self.group), 2)
+            release.set()
+            self.assertEqual(await asyncio.gather(*waiters), [1] * 10)
+            self.assertEqual(await other, 2)
+            self.assertEqual(self.calls, 2)
+            self.assertEqual(len(self.group), 0)
+            # Once landed, the next call computes again:
+            self.assertEqual(await self.group.do('a', self.compute, 3, release), 3)
+        self.loop.run_until_complete(run())
+
+    def test_exception(self):
+        async def run():
+            release = asyncio.Event()
+            waiters = [
+                asyncio.ensure_future(self.group.do('a', self.compute, KeyError('a'), release))
+                for _ in range(3)
+            ]
+            await asyncio.sleep(0)
+            release.set()
+            for result in await asyncio.gather(*waiters, return_exceptions=True):
+                self.assertIsInstance(result, KeyError)
+            self.assertEqual(self.calls, 1)
+        self.loop.run_until_complete(run())
+
+    def test_cancel_and_forget(self):
+        async def run():
+            release = asyncio.Event()
+            first = asyncio.ensure_future(self.group.do('a', self.compute, 1, release))
+            second = asyncio.ensure_future(self.group.do('a', self.compute, 2, release))
+            await asyncio.sleep(0)
+            # Cancelling one caller doesn't cancel the computation:
+            first.cancel()
+            self.group.forget('a')
+            third = asyncio.ensure_future(self.group.do('a', self.compute, 3, release))
+            await asyncio.sleep(0)
+            release.set()
+            self.assertEqual(await second, 1)
+            self.assertEqual(await third, 3)
+            self.assertTrue(first.cancelled())
+            self.assertEqual(self.calls, 2)
+        self.loop.run_until_complete(run())